@@ -0,0 +1,897 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-process stand-in for the slice of bpy, bmesh and mathutils the add-ons
+use, so p3m_importer and p3m_exporter can be timed without Blender.
+
+Collections keep their properties in NumPy columns and foreach_get and
+foreach_set copy whole columns, like the real ones do. Nothing is drawn or
+evaluated: custom split normals simply become the vertex normals and
+mesh.validate never finds anything to fix.
+
+    import benchmarks.blender_stub as blender_stub
+    bpy = blender_stub.install()
+    import p3m_importer
+"""
+
+import os
+import re
+import sys
+import time
+import types
+
+import numpy as np
+
+
+# mathutils
+
+class Vector():
+    def __init__(self, values=(0.0, 0.0, 0.0)):
+        self._data = np.array(values, dtype=np.float64)
+
+    @classmethod
+    def _view(cls, data):
+        # Writes to the vector go to the collection column it came from
+        vector = cls.__new__(cls)
+        vector._data = data
+        return vector
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, i):
+        return float(self._data[i])
+
+    def __setitem__(self, i, value):
+        self._data[i] = value
+
+    def __iter__(self):
+        return iter(self._data.tolist())
+
+    def __array__(self, dtype=None):
+        return np.asarray(self._data, dtype=dtype)
+
+    def __repr__(self):
+        return "Vector({})".format(tuple(self._data.tolist()))
+
+    def _get(i):
+        return property(lambda self: float(self._data[i]),
+                        lambda self, value: self._data.__setitem__(i, value))
+
+    x, y, z = _get(0), _get(1), _get(2)
+    del _get
+
+
+class Matrix():
+    def __init__(self, rows=None):
+        self._data = np.identity(4) if rows is None else np.array(rows, dtype=np.float64)
+
+    @classmethod
+    def Identity(cls, size):
+        return cls(np.identity(size))
+
+    @classmethod
+    def Translation(cls, vector):
+        matrix = cls()
+        matrix._data[:3, 3] = vector
+        return matrix
+
+    def to_3x3(self):
+        return Matrix(self._data[:3, :3])
+
+    def __array__(self, dtype=None):
+        return np.asarray(self._data, dtype=dtype)
+
+    def __matmul__(self, other):
+        if isinstance(other, Matrix):
+            return Matrix(self._data @ other._data)
+
+        vector = np.asarray(other, dtype=np.float64)
+        size = len(self._data)
+        if len(vector) == size - 1:
+            # 4x4 @ 3D vector is a point transform
+            return Vector(self._data[:-1, :-1] @ vector + self._data[:-1, -1])
+        return Vector(self._data @ vector)
+
+
+# bpy.types
+
+class bpy_struct():
+    def __init__(self):
+        self._properties = {}
+
+    def get(self, key, default=None):
+        return self._properties.get(key, default)
+
+    def __getitem__(self, key):
+        return self._properties[key]
+
+    def __setitem__(self, key, value):
+        self._properties[key] = value
+
+    def __contains__(self, key):
+        return key in self._properties
+
+
+class ID(bpy_struct):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+
+    @property
+    def original(self):
+        # Nothing is evaluated, every ID is its own original
+        return self
+
+
+class Property():
+    def __init__(self, is_readonly=False):
+        self.is_readonly = is_readonly
+
+
+class RNA():
+    def __init__(self, readonly=()):
+        self.properties = _PropertyTable(readonly)
+
+
+class _PropertyTable():
+    def __init__(self, readonly):
+        self._readonly = set(readonly)
+
+    def __getitem__(self, name):
+        return Property(name in self._readonly)
+
+
+class Element():
+    """
+    One item of a ColumnCollection, reading and writing its columns.
+    """
+    def __init__(self, collection, index):
+        object.__setattr__(self, "_collection", collection)
+        object.__setattr__(self, "index", index)
+
+    def __getattr__(self, name):
+        columns = self._collection._columns
+        if name not in columns:
+            return self._collection._element_attribute(self.index, name)
+        value = columns[name][self.index]
+        if value.shape == (1,):
+            return value[0].item()
+        return Vector._view(value)
+
+    def __setattr__(self, name, value):
+        self._collection._columns[name][self.index] = value
+
+
+class ColumnCollection():
+    """
+    bpy_prop_collection of plain records stored as NumPy columns.
+    """
+    columns = {}
+    readonly = ()
+
+    def __init__(self, count=0):
+        self._columns = {name: np.zeros((count, size), dtype=dtype)
+                         for name, (dtype, size) in self.columns.items()}
+        self.bl_rna = RNA(self.readonly)
+
+    def __len__(self):
+        return len(next(iter(self._columns.values())))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("bpy_prop_collection[index]: index {} out of range".format(index))
+        return Element(self, index)
+
+    def __iter__(self):
+        return (Element(self, i) for i in range(len(self)))
+
+    def _element_attribute(self, index, name):
+        raise AttributeError(name)
+
+    def add(self, count):
+        for name, column in self._columns.items():
+            self._columns[name] = np.concatenate((column, np.zeros((count,) + column.shape[1:], column.dtype)))
+
+    def foreach_get(self, name, seq):
+        values = self._columns[name].ravel()
+        if len(seq) != len(values):
+            raise RuntimeError("internal error setting the array")
+        seq[:] = values
+
+    def foreach_set(self, name, seq):
+        column = self._columns[name]
+        values = np.asarray(seq)
+        if values.size != column.size:
+            raise RuntimeError("internal error setting the array")
+        column[:] = values.reshape(column.shape)
+
+
+class MeshVertices(ColumnCollection):
+    columns = {"co": (np.float32, 3), "normal": (np.float32, 3)}
+
+    def __init__(self, count=0):
+        super().__init__(count)
+        self._groups = [{} for _ in range(count)]
+
+    def add(self, count):
+        super().add(count)
+        self._groups.extend({} for _ in range(count))
+
+    def _element_attribute(self, index, name):
+        if name == "groups":
+            return [VertexGroupElement(group, weight) for group, weight in sorted(self._groups[index].items())]
+        raise AttributeError(name)
+
+
+class VertexGroupElement():
+    def __init__(self, group, weight):
+        self.group = group
+        self.weight = weight
+
+
+class MeshLoops(ColumnCollection):
+    columns = {"vertex_index": (np.int32, 1), "normal": (np.float32, 3)}
+
+
+class MeshLoopTriangles(ColumnCollection):
+    columns = {"vertices": (np.int32, 3), "loops": (np.int32, 3), "polygon_index": (np.int32, 1)}
+
+
+class MeshPolygons(ColumnCollection):
+    columns = {"loop_start": (np.int32, 1), "loop_total": (np.int32, 1), "use_smooth": (bool, 1)}
+
+    def __init__(self, mesh, count=0):
+        super().__init__(count)
+        self._mesh = mesh
+
+    def _element_attribute(self, index, name):
+        start = int(self._columns["loop_start"][index, 0])
+        total = int(self._columns["loop_total"][index, 0])
+        if name == "loop_indices":
+            return range(start, start + total)
+        if name == "vertices":
+            return self._mesh.loops._columns["vertex_index"][start:start + total, 0].tolist()
+        raise AttributeError(name)
+
+
+class MeshUVLoops(ColumnCollection):
+    columns = {"uv": (np.float32, 2)}
+
+
+class MeshUVLoopLayer(bpy_struct):
+    def __init__(self, name, count):
+        super().__init__()
+        self.name = name
+        self.data = MeshUVLoops(count)
+
+
+class UVLoopLayers(list):
+    def __init__(self, mesh):
+        super().__init__()
+        self._mesh = mesh
+        self.active = None
+
+    def new(self, name="UVMap"):
+        layer = MeshUVLoopLayer(name, len(self._mesh.loops))
+        self.append(layer)
+        if self.active is None:
+            self.active = layer
+        return layer
+
+
+class Mesh(ID):
+    def __init__(self, name):
+        super().__init__(name)
+        self.vertices = MeshVertices()
+        self.loops = MeshLoops()
+        self.polygons = MeshPolygons(self)
+        self.uv_layers = UVLoopLayers(self)
+        self.loop_triangles = MeshLoopTriangles()
+        self.use_auto_smooth = False
+
+    def update(self, calc_edges=False):
+        # UV layers follow the loop count, as they do after a real update
+        for layer in self.uv_layers:
+            missing = len(self.loops) - len(layer.data)
+            if missing > 0:
+                layer.data.add(missing)
+
+    def validate(self, verbose=False, clean_customdata=True):
+        return False
+
+    def normals_split_custom_set_from_vertices(self, normals):
+        self.vertices.foreach_set("normal", np.asarray(normals, dtype=np.float32).ravel())
+
+    def calc_loop_triangles(self):
+        # Polygons are split as fans around their first loop
+        starts = self.polygons._columns["loop_start"][:, 0]
+        totals = self.polygons._columns["loop_total"][:, 0]
+        counts = np.maximum(totals - 2, 0)
+
+        polygons = np.repeat(np.arange(len(starts), dtype=np.int32), counts)
+        offsets = np.arange(len(polygons)) - np.repeat(np.cumsum(counts) - counts, counts)
+        first = starts[polygons]
+        loops = np.stack((first, first + offsets + 1, first + offsets + 2), axis=1)
+
+        self.loop_triangles = MeshLoopTriangles(len(loops))
+        self.loop_triangles.foreach_set("loops", loops.ravel())
+        self.loop_triangles.foreach_set("vertices", self.loops._columns["vertex_index"][loops.ravel(), 0])
+        self.loop_triangles.foreach_set("polygon_index", polygons)
+
+    def calc_normals_split(self):
+        # Custom normals were stored on the vertices, every corner takes the
+        # normal of its vertex
+        vertex_index = self.loops._columns["vertex_index"][:, 0]
+        self.loops._columns["normal"][:] = self.vertices._columns["normal"][vertex_index]
+
+    def transform(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float64)
+        co = self.vertices._columns["co"]
+        co[:] = co @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+class Bone(bpy_struct):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.head = Vector()
+        self.tail = Vector()
+        self.parent = None
+        self.hide = False
+
+
+class EditBone(Bone):
+    pass
+
+
+class BoneCollection(list):
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            for bone in self:
+                if bone.name == key:
+                    return bone
+            raise KeyError("bpy_prop_collection[key]: key \"{}\" not found".format(key))
+        return list.__getitem__(self, key)
+
+
+class ArmatureEditBones(BoneCollection):
+    def new(self, name):
+        bone = EditBone(name)
+        self.append(bone)
+        return bone
+
+
+class Armature(ID):
+    def __init__(self, name):
+        super().__init__(name)
+        self.bones = BoneCollection()
+        self.edit_bones = ArmatureEditBones()
+
+    def transform(self, matrix):
+        bones = self.edit_bones if self.edit_bones else self.bones
+        for bone in bones:
+            bone.head = matrix @ bone.head
+            bone.tail = matrix @ bone.tail
+
+    def _enter_edit(self):
+        self.edit_bones = ArmatureEditBones()
+        for bone in self.bones:
+            edit_bone = self.edit_bones.new(bone.name)
+            edit_bone.head = Vector(bone.head)
+            edit_bone.tail = Vector(bone.tail)
+            edit_bone.hide = bone.hide
+        self._copy_parents(self.bones, self.edit_bones)
+
+    def _leave_edit(self):
+        hidden = {bone.name: bone.hide for bone in self.bones}
+        self.bones = BoneCollection()
+        for edit_bone in self.edit_bones:
+            bone = Bone(edit_bone.name)
+            bone.head = Vector(edit_bone.head)
+            bone.tail = Vector(edit_bone.tail)
+            bone.hide = hidden.get(edit_bone.name, False)
+            self.bones.append(bone)
+        self._copy_parents(self.edit_bones, self.bones)
+        self.edit_bones = ArmatureEditBones()
+
+    @staticmethod
+    def _copy_parents(source, target):
+        index = {bone.name: i for i, bone in enumerate(source)}
+        for bone, copy in zip(source, target):
+            copy.parent = target[index[bone.parent.name]] if bone.parent else None
+
+
+class PoseBone():
+    def __init__(self, bone, parent):
+        self.name = bone.name
+        self.bone = bone
+        self.parent = parent
+        self.location = Vector()
+        self.matrix = Matrix.Translation(np.asarray(bone.head))
+
+
+class PoseBones(list):
+    def foreach_get(self, name, seq):
+        if name == "matrix":
+            # Matrices come out column by column
+            values = [np.asarray(bone.matrix).T.ravel() for bone in self]
+        else:
+            values = [np.asarray(getattr(bone, name)).ravel() for bone in self]
+        values = np.concatenate(values) if values else np.zeros(0)
+        if len(seq) != len(values):
+            raise RuntimeError("internal error setting the array")
+        seq[:] = values
+
+
+class Pose():
+    def __init__(self, armature):
+        self.bones = PoseBones()
+        for bone in armature.bones:
+            parent = self.bones[armature.bones.index(bone.parent)] if bone.parent else None
+            self.bones.append(PoseBone(bone, parent))
+
+
+class VertexGroup():
+    def __init__(self, obj, name, index):
+        self._object = obj
+        self.name = name
+        self.index = index
+
+    def add(self, index, weight, type):
+        groups = self._object.data.vertices._groups
+        for i in index:
+            if type == 'ADD':
+                groups[i][self.index] = groups[i].get(self.index, 0.0) + weight
+            elif type == 'SUBTRACT':
+                groups[i][self.index] = groups[i].get(self.index, 0.0) - weight
+            else:
+                groups[i][self.index] = weight
+
+
+class VertexGroups(list):
+    def __init__(self, obj):
+        super().__init__()
+        self._object = obj
+
+    def new(self, name="Group"):
+        group = VertexGroup(self._object, name, len(self))
+        self.append(group)
+        return group
+
+
+class Modifier():
+    def __init__(self, name, type):
+        self.name = name
+        self.type = type
+        self.object = None
+
+
+class ObjectModifiers(list):
+    def new(self, name, type):
+        modifier = Modifier(name, type)
+        self.append(modifier)
+        return modifier
+
+
+class Object(ID):
+    def __init__(self, name, data):
+        super().__init__(name)
+        self.data = data
+        self.type = {Mesh: 'MESH', Armature: 'ARMATURE'}.get(type(data), 'EMPTY')
+        self.parent = None
+        self.matrix_world = Matrix()
+        self.mode = 'OBJECT'
+        self.select = False
+        self.vertex_groups = VertexGroups(self)
+        self.modifiers = ObjectModifiers()
+        self._pose = None
+
+    @property
+    def pose(self):
+        if self.type != 'ARMATURE':
+            return None
+        if self._pose is None or len(self._pose.bones) != len(self.data.bones):
+            self._pose = Pose(self.data)
+        return self._pose
+
+    def select_get(self):
+        return self.select
+
+    def select_set(self, state):
+        self.select = state
+
+
+class Operator():
+    bl_idname = ""
+    bl_label = ""
+
+    def report(self, type, message):
+        print("{}: {}".format(", ".join(sorted(type)), message))
+
+
+class OperatorFileListElement():
+    pass
+
+
+class PropertyGroup():
+    pass
+
+
+class Menu(list):
+    def append(self, draw):
+        list.append(self, draw)
+
+
+# bpy.data and bpy.context
+
+class BlendDataCollection(list):
+    def __init__(self, factory):
+        super().__init__()
+        self._factory = factory
+
+    def new(self, name, *args):
+        item = self._factory(self._unique(name), *args)
+        self.append(item)
+        return item
+
+    def remove(self, item):
+        list.remove(self, item)
+
+    def get(self, name, default=None):
+        for item in self:
+            if item.name == name:
+                return item
+        return default
+
+    def _unique(self, name):
+        names = {item.name for item in self}
+        unique = name
+        i = 0
+        while unique in names:
+            i += 1
+            unique = "{}.{:03d}".format(name, i)
+        return unique
+
+
+class BlendData():
+    def __init__(self):
+        self.objects = BlendDataCollection(Object)
+        self.meshes = BlendDataCollection(Mesh)
+        self.armatures = BlendDataCollection(Armature)
+
+
+class CollectionObjects(list):
+    def link(self, obj):
+        if obj in self:
+            raise RuntimeError("Object '{}' already in collection".format(obj.name))
+        self.append(obj)
+
+
+class Collection():
+    def __init__(self):
+        self.objects = CollectionObjects()
+
+
+class LayerObjects():
+    def __init__(self):
+        self.active = None
+
+
+class ViewLayer():
+    def __init__(self):
+        self.objects = LayerObjects()
+
+
+class Scene():
+    def __init__(self, collection):
+        self.collection = collection
+
+    @property
+    def objects(self):
+        return self.collection.objects
+
+
+class Context():
+    def __init__(self):
+        self.collection = Collection()
+        self.scene = Scene(self.collection)
+        self.view_layer = ViewLayer()
+
+    @property
+    def active_object(self):
+        return self.view_layer.objects.active
+
+    @property
+    def object(self):
+        return self.view_layer.objects.active
+
+    @property
+    def selected_objects(self):
+        return [obj for obj in self.scene.objects if obj.select]
+
+
+class DepsgraphUpdate():
+    def __init__(self, id):
+        self.id = id
+        self.is_updated_geometry = True
+        self.is_updated_transform = True
+
+
+class Depsgraph():
+    def __init__(self, ids):
+        self.updates = [DepsgraphUpdate(id) for id in ids]
+
+
+def depsgraph_update(*ids):
+    """
+    Calls the depsgraph_update_post handlers as if ids had just changed.
+    """
+    depsgraph = Depsgraph(ids)
+    for handler in list(_bpy.app.handlers.depsgraph_update_post):
+        handler(_bpy.context.scene, depsgraph)
+
+
+class Timers():
+    """
+    Timers never fire on their own, run_pending calls the ones that are due.
+    """
+    def __init__(self):
+        self._due = {}
+
+    def register(self, function, first_interval=0.0, persistent=False):
+        self._due[function] = time.monotonic() + first_interval
+
+    def unregister(self, function):
+        if function not in self._due:
+            raise ValueError("Error: function is not registered")
+        del self._due[function]
+
+    def is_registered(self, function):
+        return function in self._due
+
+    def run_pending(self):
+        now = time.monotonic()
+        for function, due in list(self._due.items()):
+            if due > now:
+                continue
+            del self._due[function]
+            interval = function()
+            if interval is not None:
+                self._due[function] = now + interval
+
+
+def mode_set(mode='OBJECT'):
+    obj = _bpy.context.view_layer.objects.active
+    if obj is None:
+        raise RuntimeError("Operator bpy.ops.object.mode_set.poll() failed, context is incorrect")
+    if obj.type == 'ARMATURE':
+        if mode == 'EDIT' and obj.mode != 'EDIT':
+            obj.data._enter_edit()
+        elif mode != 'EDIT' and obj.mode == 'EDIT':
+            obj.data._leave_edit()
+    obj.mode = mode
+    return {'FINISHED'}
+
+
+# bmesh
+
+class BMVert():
+    def __init__(self, co):
+        self.co = Vector(co)
+        self.normal = Vector()
+        self.index = -1
+        self.link_faces = []
+
+
+class BMLoop():
+    def __init__(self, vert):
+        self.vert = vert
+        self._layers = {}
+
+    def __getitem__(self, layer):
+        if layer not in self._layers:
+            self._layers[layer] = BMLoopUV()
+        return self._layers[layer]
+
+
+class BMLoopUV():
+    def __init__(self):
+        self.uv = (0.0, 0.0)
+
+
+class BMFace():
+    def __init__(self, verts):
+        self.verts = list(verts)
+        self.loops = [BMLoop(vert) for vert in self.verts]
+        self.smooth = False
+
+
+class BMVertSeq(list):
+    def new(self, co=(0.0, 0.0, 0.0)):
+        vert = BMVert(co)
+        self.append(vert)
+        return vert
+
+    def ensure_lookup_table(self):
+        pass
+
+    def index_update(self):
+        for i, vert in enumerate(self):
+            vert.index = i
+
+
+class BMFaceSeq(list):
+    def __init__(self):
+        super().__init__()
+        self._keys = set()
+
+    def new(self, verts):
+        key = frozenset(id(vert) for vert in verts)
+        if len(key) != len(verts):
+            raise ValueError("faces.new(verts): found the same (BMVert) used multiple times")
+        if key in self._keys:
+            raise ValueError("faces.new(verts): face already exists")
+        self._keys.add(key)
+
+        face = BMFace(verts)
+        for vert in verts:
+            vert.link_faces.append(face)
+        self.append(face)
+        return face
+
+
+class BMLayerCollection():
+    def __init__(self):
+        self._layer = None
+
+    def verify(self):
+        if self._layer is None:
+            self._layer = object()
+        return self._layer
+
+
+class BMLayerAccessLoop():
+    def __init__(self):
+        self.uv = BMLayerCollection()
+
+
+class BMLoopSeq():
+    def __init__(self):
+        self.layers = BMLayerAccessLoop()
+
+
+class BMesh():
+    def __init__(self):
+        self.verts = BMVertSeq()
+        self.faces = BMFaceSeq()
+        self.loops = BMLoopSeq()
+
+    def to_mesh(self, mesh):
+        self.verts.index_update()
+
+        mesh.vertices.add(len(self.verts))
+        mesh.vertices.foreach_set("co", np.array([tuple(vert.co) for vert in self.verts], dtype=np.float32).ravel())
+        mesh.vertices.foreach_set("normal", np.array([tuple(vert.normal) for vert in self.verts], dtype=np.float32).ravel())
+
+        totals = [len(face.verts) for face in self.faces]
+        mesh.loops.add(sum(totals))
+        mesh.loops.foreach_set("vertex_index", np.array([vert.index for face in self.faces for vert in face.verts], dtype=np.int32))
+
+        mesh.polygons.add(len(self.faces))
+        mesh.polygons.foreach_set("loop_start", np.cumsum([0] + totals[:-1], dtype=np.int32))
+        mesh.polygons.foreach_set("loop_total", np.array(totals, dtype=np.int32))
+        mesh.polygons.foreach_set("use_smooth", np.array([face.smooth for face in self.faces], dtype=bool))
+
+        layer = self.loops.layers.uv._layer
+        if layer is not None:
+            uv_layer = mesh.uv_layers.new()
+            uvs = [loop[layer].uv for face in self.faces for loop in face.loops]
+            uv_layer.data.foreach_set("uv", np.array(uvs, dtype=np.float32).ravel())
+
+    def free(self):
+        self.verts = BMVertSeq()
+        self.faces = BMFaceSeq()
+
+
+# Modules
+
+_bpy = None
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    return module
+
+
+def _property(kind):
+    def factory(**keywords):
+        return (kind, keywords)
+    factory.__name__ = kind
+    return factory
+
+
+def install():
+    """
+    Registers the stand-in bpy, bpy_extras, bmesh and mathutils modules and
+    returns bpy. Installing again starts from an empty scene.
+    """
+    global _bpy
+
+    props = _module("bpy.props", **{kind: _property(kind) for kind in (
+        "BoolProperty", "CollectionProperty", "EnumProperty", "FloatProperty",
+        "IntProperty", "PointerProperty", "StringProperty")})
+
+    bpy_types = _module("bpy.types",
+        bpy_struct=bpy_struct, ID=ID, Mesh=Mesh, Armature=Armature, Object=Object,
+        Operator=Operator, OperatorFileListElement=OperatorFileListElement, PropertyGroup=PropertyGroup,
+        TOPBAR_MT_file_import=Menu(), TOPBAR_MT_file_export=Menu())
+
+    bpy = _module("bpy",
+        props=props,
+        types=bpy_types,
+        data=BlendData(),
+        context=Context(),
+        ops=_module("bpy.ops", object=_module("bpy.ops.object", mode_set=mode_set)),
+        path=_module("bpy.path",
+                     basename=lambda path: os.path.basename(path[2:] if path.startswith("//") else path),
+                     clean_name=lambda name, replace="_": re.sub(r"[^A-Za-z0-9_]", replace, name)),
+        utils=_module("bpy.utils", register_class=lambda cls: None, unregister_class=lambda cls: None),
+        app=_module("bpy.app", version=(2, 83, 1), background=True,
+                    handlers=_module("bpy.app.handlers", depsgraph_update_post=[], persistent=lambda function: function),
+                    timers=Timers()))
+
+    class ImportHelper():
+        pass
+
+    class ExportHelper():
+        pass
+
+    io_utils = _module("bpy_extras.io_utils", ImportHelper=ImportHelper, ExportHelper=ExportHelper)
+    bpy_extras = _module("bpy_extras", io_utils=io_utils)
+
+    mathutils = _module("mathutils", Vector=Vector, Matrix=Matrix)
+    bmesh = _module("bmesh", new=BMesh)
+
+    sys.modules.update({
+        "bpy": bpy,
+        "bpy.props": props,
+        "bpy.types": bpy_types,
+        "bpy.ops": bpy.ops,
+        "bpy.path": bpy.path,
+        "bpy.utils": bpy.utils,
+        "bpy.app": bpy.app,
+        "bpy.app.handlers": bpy.app.handlers,
+        "bpy_extras": bpy_extras,
+        "bpy_extras.io_utils": io_utils,
+        "mathutils": mathutils,
+        "bmesh": bmesh,
+    })
+
+    _bpy = bpy
+    return bpy
+
+
+def reset():
+    """
+    Empties the scene and the blend data of the installed stand-in.
+    """
+    _bpy.data = BlendData()
+    _bpy.context = Context()
+    _bpy.app.handlers.depsgraph_update_post.clear()
+    _bpy.app.timers = Timers()
+    return _bpy
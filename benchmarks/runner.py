@@ -0,0 +1,335 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Times the import and export paths on synthetic models and compares the
+results against stored baselines.
+
+Every benchmark keeps the median of a number of samples, each sample
+looping the benchmark for a minimum wall time so sub-millisecond cases are
+not at the mercy of the timer and the scheduler. Timings are divided by a
+fixed calibration workload run right before and after each sample, so
+baselines recorded on one machine stay meaningful on another and a machine
+that speeds up or slows down during the run does not skew the ratios. A
+benchmark slower than its baseline by more than the tolerance fails the run.
+
+    python -m benchmarks                     # compare against baselines.json
+    python -m benchmarks --update            # record new baselines
+    python -m benchmarks --sizes small -k decode
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+import p3m_cache
+import p3m_codec
+import p3m_optimize
+import p3m_skeleton
+from benchmarks import blender_stub, synthetic
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+# (bones, vertices, faces)
+SIZES = {
+    "small": (16, 500, 800),
+    "medium": (48, 8000, 12000),
+    "large": (120, 60000, 65000),
+}
+
+DEFAULT_TOLERANCE = 0.25
+
+# Wall time of one sample, the benchmark is looped until it is reached
+SAMPLE_SECONDS = 0.05
+
+# Per size, benchmarks faster than this are reported but never fail: even
+# looped, their timings are dominated by cache and allocator effects
+NOISE_FLOORS = {
+    "small": 0.0002,
+    "medium": 0.0005,
+    "large": 0.002,
+}
+
+
+def export_options(filepath, **options):
+    """
+    Stands in for the ExportFile operator, with its default options.
+    """
+    defaults = {
+        "filepath": filepath,
+        "merge_distance": 1e-6,
+        "optimize_vertex_cache": False,
+        "vertex_cache_size": p3m_optimize.DEFAULT_CACHE_SIZE,
+        "lod_levels": 0,
+        "lod_ratio": 0.5,
+        "batch_mode": False,
+        "selected_only": False,
+        "filename_ext": ".p3m",
+    }
+    defaults.update(options)
+    return SimpleNamespace(**defaults)
+
+
+def calibrate(repeat=1):
+    """
+    Median seconds taken by a fixed mix of NumPy and interpreter work.
+    """
+    data = np.random.default_rng(0).random(1 << 17)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        np.sort(data)
+        total = 0
+        for i in range(100000):
+            total += i & 7
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def measure(function, repeat, sample_seconds=SAMPLE_SECONDS):
+    """
+    Returns the median seconds function takes and the median of the same
+    samples divided by the calibration workload run on either side of each.
+    Each sample averages as many runs as fit in sample_seconds of wall time.
+    """
+    start = time.perf_counter()
+    function()
+    wall = time.perf_counter() - start
+    loops = max(1, int(math.ceil(sample_seconds / max(wall, 1e-9))))
+
+    # Like timeit, keep collections from landing in random samples
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        samples = []
+        normalized = []
+        before = calibrate()
+        for _ in range(repeat):
+            total = 0.0
+            for _ in range(loops):
+                total += function()
+            gc.collect()
+            after = calibrate()
+
+            seconds = total / loops
+            samples.append(seconds)
+            normalized.append(seconds / ((before + after) / 2))
+            before = after
+    finally:
+        if enabled:
+            gc.enable()
+    return statistics.median(samples), statistics.median(normalized)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+class Benchmarks():
+    """
+    The benchmarks of one model size. Each method returns the seconds of
+    one run.
+    """
+    def __init__(self, directory, size, num_bones, num_vertices, num_faces):
+
+        self.path = os.path.join(directory, "{}.p3m".format(size))
+        synthetic.write_p3m(self.path, num_bones, num_vertices, num_faces)
+        with open(self.path, 'rb') as file:
+            self.buffer = file.read()
+        self.model = p3m_codec.decode_p3m(self.buffer)
+        self.export_path = os.path.join(directory, "{}_export.p3m".format(size))
+        self.cache_directory = os.path.join(directory, "{}_cache".format(size))
+
+    def decode(self):
+        return timed(p3m_codec.decode_p3m, self.buffer)
+
+    def load(self):
+        import p3m_importer
+        return timed(p3m_importer.decode_file, self.path)
+
+    def cached(self):
+        import p3m_importer
+        cache = p3m_cache.DecodeCache(directory=self.cache_directory)
+        p3m_importer.decode_file(self.path, cache)
+        return timed(p3m_importer.decode_file, self.path, cache)
+
+    def skeleton(self):
+        return timed(p3m_skeleton.resolve_skeleton, self.model.position_bones, self.model.angle_bones)
+
+    def _build(self):
+        import p3m_importer
+        bpy = blender_stub.reset()
+        decoded = p3m_importer.decode_file(self.path)
+        p3m_importer.build_p3m(bpy.context, decoded, hide_unused_bones=True)
+        return decoded.timer
+
+    def _phase(self, name):
+        for phase in self._build().phases:
+            if phase.name == name:
+                return phase.seconds
+        raise KeyError(name)
+
+    def armature(self):
+        return self._phase("skeleton")
+
+    def mesh(self):
+        return self._phase("mesh")
+
+    def skinning(self):
+        return self._phase("skinning")
+
+    def serialize(self):
+        return timed(p3m_codec.encode_p3m, self.model)
+
+    def export(self):
+        import p3m_exporter
+        import p3m_importer
+        bpy = blender_stub.reset()
+        p3m_importer.import_p3m(bpy.context, self.path, hide_unused_bones=False)
+        operator = export_options(self.export_path)
+        return timed(p3m_exporter.export_object, operator, bpy.context)
+
+    def optimize(self):
+        faces = self.model.triangles['index']
+        return timed(p3m_optimize.optimize_faces, faces, len(self.model.vertices))
+
+    def roundtrip(self):
+        import p3m_exporter
+        import p3m_importer
+
+        start = time.perf_counter()
+        bpy = blender_stub.reset()
+        p3m_importer.import_p3m(bpy.context, self.path, hide_unused_bones=False)
+        operator = export_options(self.export_path)
+        p3m_exporter.export_object(operator, bpy.context)
+        model = p3m_codec.load_p3m(self.export_path)
+        seconds = time.perf_counter() - start
+
+        check_roundtrip(self.model, model)
+        return seconds
+
+
+def check_roundtrip(source, model, tolerance=1e-4):
+    """
+    Raises AssertionError unless model has the skeleton of source and the
+    same bone and absolute position at every triangle corner.
+    """
+    if len(model.vertices) != len(source.vertices) or len(model.triangles) != len(source.triangles):
+        raise AssertionError("Round trip changed the mesh: {} vertices and {} faces instead of {} and {}".format(
+            len(model.vertices), len(model.triangles), len(source.vertices), len(source.triangles)))
+
+    expected = p3m_skeleton.resolve_skeleton(source.position_bones, source.angle_bones)
+    skeleton = p3m_skeleton.resolve_skeleton(model.position_bones, model.angle_bones)
+    if skeleton.tree.parents != expected.tree.parents:
+        raise AssertionError("Round trip changed the bone hierarchy")
+    error = np.abs(skeleton.heads - expected.heads).max(initial=0.0)
+    if error > tolerance:
+        raise AssertionError("Round trip moved bone heads by up to {:g}".format(error))
+
+    # Vertices may be renumbered, triangle corners keep their order
+    corners = source.triangles['index'].ravel()
+    exported = model.triangles['index'].ravel()
+    bones = p3m_skeleton.vertex_bones(source)
+    model_bones = p3m_skeleton.vertex_bones(model)
+    if not np.array_equal(bones[corners], model_bones[exported]):
+        raise AssertionError("Round trip changed vertex bones")
+
+    positions = p3m_skeleton.absolute_positions(source, expected, bones)[corners]
+    model_positions = p3m_skeleton.absolute_positions(model, skeleton, model_bones)[exported]
+    error = np.abs(positions - model_positions).max(initial=0.0)
+    if error > tolerance:
+        raise AssertionError("Round trip moved vertices by up to {:g}".format(error))
+
+
+NAMES = ["decode", "load", "cached", "skeleton", "armature", "mesh", "skinning", "serialize", "export", "optimize", "roundtrip"]
+
+
+def load_baselines(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", choices=sorted(SIZES), default=list(SIZES))
+    parser.add_argument("-k", "--only", nargs="+", choices=NAMES, default=NAMES, help="benchmarks to run")
+    parser.add_argument("-r", "--repeat", type=int, default=15, help="samples per benchmark, the median counts")
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown against the baseline, 0.25 is 25%% (default %(default)s)")
+    parser.add_argument("--update", action="store_true", help="record the results as the new baselines")
+    args = parser.parse_args(argv)
+
+    blender_stub.install()
+    import p3m_profile
+    p3m_profile.set_verbosity('WARNING')
+
+    # Every sample is normalized by a calibration taken right around it, so
+    # drift in the machine's speed during the run cancels out
+    timings = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            benchmarks = Benchmarks(directory, size, *SIZES[size])
+            for name in args.only:
+                seconds, normalized = measure(getattr(benchmarks, name), args.repeat)
+                timings.append((size, "{}/{}".format(size, name), seconds, normalized))
+
+    calibration = statistics.median(seconds / normalized for _, _, seconds, normalized in timings)
+    baselines = load_baselines(args.baselines)
+    scale = calibration / baselines["calibration"] if "calibration" in baselines else 1.0
+    results = dict(baselines.get("results", {}))
+
+    regressions = []
+    print("calibration {:.2f} ms ({:.2f}x the baseline machine)".format(calibration * 1000.0, scale))
+    print("{:<22} {:>11} {:>11} {:>8}".format("benchmark", "ms", "baseline", "ratio"))
+
+    for size, key, seconds, normalized in timings:
+        results[key] = normalized
+
+        line = "{:<22} {:>11.2f}".format(key, seconds * 1000.0)
+        baseline = baselines.get("results", {}).get(key)
+        if baseline is not None:
+            ratio = normalized / baseline
+            expected = seconds / ratio
+            line += " {:>11.2f} {:>7.2f}x".format(expected * 1000.0, ratio)
+            if ratio > 1.0 + args.tolerance and seconds > NOISE_FLOORS[size]:
+                line += "  REGRESSION"
+                regressions.append(key)
+        print(line)
+
+    if args.update:
+        with open(args.baselines, 'w') as file:
+            json.dump({"calibration": calibration, "results": results}, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print("Baselines written to {}".format(args.baselines))
+        return 0
+
+    if regressions:
+        print("{} benchmark(s) slower than their baseline by more than {:.0%}: {}".format(
+            len(regressions), args.tolerance, ", ".join(regressions)), file=sys.stderr)
+        return 1
+    return 0
@@ -0,0 +1,100 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Deterministic generator of valid P3M models.
+
+The same arguments always give the same bytes. Every angle bone sits on its
+own position bone and hangs from an earlier bone, so the skeleton is a tree
+with at most MAX_CHILDREN children per bone. The mesh is a strip of
+triangles over a wavy sheet, skinned to random bones.
+"""
+
+import numpy as np
+
+import p3m_codec
+
+
+def make_skeleton(rng, num_bones):
+    """
+    Returns (position_bones, angle_bones) of a random tree of num_bones.
+    """
+    parents = [-1]
+    children = [[] for _ in range(num_bones)]
+    for i in range(1, num_bones):
+        while True:
+            parent = int(rng.integers(0, i))
+            if len(children[parent]) < p3m_codec.MAX_CHILDREN:
+                break
+        parents.append(parent)
+        children[parent].append(i)
+
+    # Heads are relative to the parent bone, like in the game files
+    vectors = rng.uniform(-0.2, 0.2, size=(num_bones, 3))
+    vectors[0] = 0.0
+
+    # Position bone i holds angle bone i, angle bone i lists the position
+    # bones of its children
+    position_bones = p3m_codec.make_position_bones(vectors, [[i] for i in range(num_bones)])
+    angle_bones = p3m_codec.make_angle_bones(children)
+    return position_bones, angle_bones
+
+
+def make_mesh(rng, num_vertices, num_faces, num_position_bones, num_bones):
+    """
+    Returns (triangles, vertices) of a skinned mesh.
+    """
+    side = max(int(np.ceil(np.sqrt(num_vertices))), 1)
+    i = np.arange(num_vertices)
+    u = (i % side) / side
+    v = (i // side) / side
+
+    positions = np.stack((u, np.sin(u * 6.0) * np.cos(v * 6.0) * 0.1, v), axis=1)
+    normals = rng.normal(size=(num_vertices, 3))
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    uvs = np.stack((u, v), axis=1)
+
+    bones = rng.integers(0, num_bones, size=num_vertices) + num_position_bones
+    weights = np.ones(num_vertices)
+
+    # Face f joins base, base + step and base + 2 * step, the step growing
+    # every num_vertices faces so no two triangles are the same
+    f = np.arange(num_faces)
+    base = f % num_vertices
+    step = 1 + f // num_vertices
+    indices = np.stack((base, base + step, base + 2 * step), axis=1) % num_vertices
+
+    triangles = p3m_codec.make_triangles(indices)
+    vertices = p3m_codec.make_vertices(positions, weights, bones, normals, uvs)
+    return triangles, vertices
+
+
+def make_model(num_bones=32, num_vertices=1000, num_faces=1500, seed=0):
+    if not 1 <= num_bones <= 127:
+        raise ValueError("num_bones must be between 1 and 127")
+    if num_faces and 2 * (1 + (num_faces - 1) // num_vertices) >= num_vertices:
+        raise ValueError("Too many faces for {} vertices".format(num_vertices))
+
+    rng = np.random.default_rng(seed)
+    position_bones, angle_bones = make_skeleton(rng, num_bones)
+    triangles, vertices = make_mesh(rng, num_vertices, num_faces, len(position_bones), num_bones)
+    return p3m_codec.P3MModel(p3m_codec.P3M_VERSION, position_bones, angle_bones, triangles, vertices)
+
+
+def make_p3m(num_bones=32, num_vertices=1000, num_faces=1500, seed=0):
+    return p3m_codec.encode_p3m(make_model(num_bones, num_vertices, num_faces, seed))
+
+
+def write_p3m(strFilepath, num_bones=32, num_vertices=1000, num_faces=1500, seed=0):
+    with open(strFilepath, 'wb') as file:
+        file.write(make_p3m(num_bones, num_vertices, num_faces, seed))
@@ -0,0 +1,249 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+On-disk cache of decoded P3M files.
+
+Entries are keyed by a hash of the file content and hold the decoded
+sections together with the resolved skeleton and any extra arrays the
+caller derived from them, so a repeat import skips parsing, hierarchy
+resolution and the vertex transform. A small reference file maps the path,
+size, inode, modification time and change time of a file to its content
+key, so the content is only hashed when a file is new or was touched. The
+least recently used entries are evicted once the cache grows past its size
+cap.
+
+A hit through a reference trusts the stat fields instead of hashing the
+file again, which would cost about as much as the decode it saves. P3M
+sizes only depend on the element counts, and copies that keep the
+modification time (cp -p, archive extraction) are common, so the inode and
+change time are part of the key too: writing a file always sets its change
+time and nothing can set it back. A file rewritten within the timestamp
+resolution of its file system can still be missed.
+
+Entries are a run of .npy records in one file, read back with one read per
+array: much cheaper than an .npz archive, which makes a hit cheaper than
+decoding the file again.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import p3m_codec
+import p3m_skeleton
+
+# Bump when the entry layout changes so stale entries are never read
+CACHE_VERSION = b"2"
+
+DEFAULT_DIRECTORY = os.path.join(tempfile.gettempdir(), "p3m_cache")
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Smaller files decode faster than an entry loads, they are never cached
+DEFAULT_MIN_FILE_BYTES = 128 * 1024
+
+ENTRY_EXT = ".entry"
+REF_EXT = ".ref"
+
+
+def content_key(strFilepath):
+    digest = hashlib.blake2b(CACHE_VERSION, digest_size=20)
+    with open(strFilepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stat_key(strFilepath, stat):
+    """
+    Key of a file's path and stat fields, without reading it.
+    """
+    digest = hashlib.blake2b(CACHE_VERSION, digest_size=20)
+    digest.update("{}\0{}\0{}\0{}\0{}".format(os.path.abspath(strFilepath), stat.st_size, stat.st_ino,
+                                            stat.st_mtime_ns, stat.st_ctime_ns).encode())
+    return digest.hexdigest()
+
+
+def _replace(path, write):
+    temp = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+    try:
+        with open(temp, 'wb') as file:
+            write(file)
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+class DecodeCache():
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, min_file_bytes=DEFAULT_MIN_FILE_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_file_bytes = min_file_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_EXT)
+
+    def _ref_path(self, key):
+        return os.path.join(self.directory, key + REF_EXT)
+
+    def lookup(self, strFilepath):
+        """
+        Returns (key, entry) for a file, the entry being (model, skeleton,
+        arrays) or None on a miss. The file is only hashed when its path
+        and stat fields do not match a known entry. Files below
+        min_file_bytes are not cached and get (None, None).
+        """
+        stat = os.stat(strFilepath)
+        if stat.st_size < self.min_file_bytes:
+            return None, None
+
+        ref = self._ref_path(stat_key(strFilepath, stat))
+        try:
+            with open(ref) as file:
+                key = file.read().strip()
+        except OSError:
+            key = None
+
+        if key:
+            entry = self.load(key)
+            if entry is not None:
+                return key, entry
+
+        key = content_key(strFilepath)
+        entry = self.load(key)
+        if entry is not None:
+            self._store_ref(strFilepath, key)
+        return key, entry
+
+    def load(self, key):
+        """
+        Returns (model, skeleton, arrays) for a key, or None on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                names = np.load(file, allow_pickle=False).tolist()
+                entry = {name: np.load(file, allow_pickle=False) for name in names}
+            model = p3m_codec.P3MModel(
+                entry.pop('version').tobytes(),
+                entry.pop('position_bones'), entry.pop('angle_bones'),
+                entry.pop('triangles'), entry.pop('vertices'),
+                entry.pop('texture').tobytes())
+            skeleton = p3m_skeleton.Skeleton(
+                p3m_skeleton.BoneTree(entry.pop('parents').tolist()),
+                entry.pop('angle_to_position').tolist(),
+                entry.pop('heads'), entry.pop('tails'))
+        except (OSError, KeyError, ValueError):
+            return None
+
+        # The modification time is the LRU clock
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return model, skeleton, entry
+
+    def store(self, key, model, skeleton, arrays=None, strFilepath=None):
+        """
+        Stores a decoded model with its skeleton and extra named arrays. With
+        strFilepath, the file is found again without hashing it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+
+        entry = {
+            'version': np.frombuffer(model.version, dtype=np.uint8),
+            'texture': np.frombuffer(model.texture, dtype=np.uint8),
+            'position_bones': model.position_bones,
+            'angle_bones': model.angle_bones,
+            'triangles': model.triangles,
+            'vertices': model.vertices,
+            'parents': np.array(skeleton.tree.parents, dtype=np.int32),
+            'angle_to_position': np.array(skeleton.angle_to_position, dtype=np.int32),
+            'heads': skeleton.heads,
+            'tails': skeleton.tails,
+        }
+        entry.update(arrays or {})
+
+        def write(file):
+            np.save(file, np.array(list(entry)), allow_pickle=False)
+            for array in entry.values():
+                np.save(file, np.ascontiguousarray(array), allow_pickle=False)
+
+        _replace(self._path(key), write)
+        if strFilepath is not None:
+            self._store_ref(strFilepath, key)
+
+        self.evict()
+
+    def _store_ref(self, strFilepath, key):
+        _replace(self._ref_path(stat_key(strFilepath, os.stat(strFilepath))), lambda file: file.write(key.encode()))
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits its cap.
+        """
+        with self._lock:
+            entries = []
+            refs = []
+            for name in os.listdir(self.directory):
+                if name.endswith(REF_EXT):
+                    refs.append(name)
+                if not name.endswith(ENTRY_EXT):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for _, size, _ in entries)
+            evicted = False
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                total -= size
+                evicted = True
+
+            # References to evicted entries would only cost a failed load
+            for name in refs if evicted else ():
+                path = os.path.join(self.directory, name)
+                try:
+                    with open(path) as file:
+                        key = file.read().strip()
+                    if not os.path.exists(self._path(key)):
+                        os.remove(path)
+                except OSError:
+                    continue
+
+    def clear(self):
+        with self._lock:
+            if not os.path.isdir(self.directory):
+                return
+            for name in os.listdir(self.directory):
+                if name.endswith((ENTRY_EXT, REF_EXT)):
+                    try:
+                        os.remove(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
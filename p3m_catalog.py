@@ -0,0 +1,286 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+SQLite catalog of P3M libraries.
+
+Every file is summarized from its memory-mapped header and bone sections:
+version, counts, texture block, skeleton fingerprint and the bounding box
+of its vertices, read through a strided view of their positions so no mesh
+is decoded. Files are only read again when their size or modification time
+changes.
+
+    python -m p3m_catalog build path/to/models
+    python -m p3m_catalog query --min-bones 40
+    python -m p3m_catalog query --same-skeleton path/to/models/elesis_body.p3m
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sqlite3
+import sys
+import time
+
+import p3m_codec
+import p3m_skeleton
+
+DEFAULT_DATABASE = "p3m_catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    version TEXT,
+    texture TEXT,
+    position_bones INTEGER,
+    angle_bones INTEGER,
+    vertices INTEGER,
+    faces INTEGER,
+    min_x REAL, min_y REAL, min_z REAL,
+    max_x REAL, max_y REAL, max_z REAL,
+    skeleton TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS models_skeleton ON models (skeleton);
+CREATE INDEX IF NOT EXISTS models_angle_bones ON models (angle_bones);
+CREATE INDEX IF NOT EXISTS models_vertices ON models (vertices);
+"""
+
+COLUMNS = ("path", "size", "mtime_ns", "version", "texture",
+           "position_bones", "angle_bones", "vertices", "faces",
+           "min_x", "min_y", "min_z", "max_x", "max_y", "max_z",
+           "skeleton", "error")
+
+
+class CatalogEntry():
+    def __init__(self, *values):
+        for name, value in zip(COLUMNS, values):
+            setattr(self, name, value)
+
+    @property
+    def bbox(self):
+        if self.min_x is None:
+            return None
+        return (self.min_x, self.min_y, self.min_z), (self.max_x, self.max_y, self.max_z)
+
+    def __repr__(self):
+        return "CatalogEntry({!r}, {} bones, {} vertices, {} faces)".format(
+            self.path, self.angle_bones, self.vertices, self.faces)
+
+
+class CatalogUpdate():
+    def __init__(self):
+        self.added = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.failed = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return "{} added, {} updated, {} unchanged, {} removed, {} failed in {:.2f}s".format(
+            self.added, self.updated, self.unchanged, self.removed, self.failed, self.seconds)
+
+
+def decode_text(data):
+    return data.split(b'\x00', 1)[0].decode('latin-1')
+
+
+def summarize(strFilepath, size, mtime_ns):
+    """
+    Returns the catalog row of a file. Files that cannot be read or hold
+    out-of-range bone indices get a row holding the error, so they are not
+    read again until they change.
+    """
+    row = dict.fromkeys(COLUMNS)
+    row.update(path=strFilepath, size=size, mtime_ns=mtime_ns)
+    try:
+        with p3m_codec.P3MReader(strFilepath) as reader:
+            # Only the position field of the vertices is read, through a
+            # strided view of the mapping
+            model = p3m_codec.P3MModel(reader.version, reader.position_bones, reader.angle_bones,
+                                       reader.triangles, reader.vertices)
+            row.update(
+                version=decode_text(reader.version),
+                texture=decode_text(reader.texture),
+                position_bones=reader.num_position_bones,
+                angle_bones=reader.num_angle_bones,
+                vertices=reader.num_vertices,
+                faces=reader.num_faces,
+                skeleton=p3m_codec.skeleton_fingerprint(model))
+
+            # Resolving checks the child indices even without vertices, the
+            # bounding box then checks the vertex bones
+            skeleton = p3m_skeleton.resolve_skeleton(model.position_bones, model.angle_bones)
+            bbox = p3m_skeleton.bounding_box(model, skeleton)
+            if bbox is not None:
+                low, high = bbox
+                (row['min_x'], row['min_y'], row['min_z']), (row['max_x'], row['max_y'], row['max_z']) = low.tolist(), high.tolist()
+            del model
+    except (OSError, p3m_codec.P3MError) as error:
+        row['error'] = str(error)
+    return tuple(row[name] for name in COLUMNS)
+
+
+def find_p3m_files(roots):
+    for root in roots:
+        if os.path.isfile(root):
+            yield os.path.abspath(root)
+            continue
+        for directory, _, files in os.walk(root):
+            for name in sorted(files):
+                if name.lower().endswith(".p3m"):
+                    yield os.path.abspath(os.path.join(directory, name))
+
+
+class Catalog():
+    def __init__(self, database=DEFAULT_DATABASE):
+        self.database = database
+        self.connection = sqlite3.connect(database)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, roots, workers=None):
+        """
+        Brings the catalog in line with the P3M files under roots: new and
+        changed files are read on a thread pool, deleted ones are dropped.
+        """
+        start = time.perf_counter()
+        stats = CatalogUpdate()
+
+        prefixes = [os.path.join(os.path.abspath(root), "") if os.path.isdir(root) else os.path.abspath(root)
+                    for root in roots]
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in
+                 self.connection.execute("SELECT path, size, mtime_ns FROM models")
+                 if any(path == prefix or path.startswith(prefix) for prefix in prefixes)}
+
+        stale = []
+        for strFilepath in find_p3m_files(roots):
+            try:
+                stat = os.stat(strFilepath)
+            except OSError:
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            previous = known.pop(strFilepath, None)
+            if previous == current:
+                stats.unchanged += 1
+                continue
+            if previous is None:
+                stats.added += 1
+            else:
+                stats.updated += 1
+            stale.append((strFilepath,) + current)
+
+        with self.connection:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                for row in pool.map(lambda job: summarize(*job), stale):
+                    if row[COLUMNS.index("error")] is not None:
+                        stats.failed += 1
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO models VALUES ({})".format(", ".join("?" * len(COLUMNS))), row)
+
+            # Whatever is left under the roots was not found on disk anymore
+            self.connection.executemany("DELETE FROM models WHERE path = ?", [(path,) for path in known])
+            stats.removed = len(known)
+
+        stats.seconds = time.perf_counter() - start
+        return stats
+
+    def get(self, strFilepath):
+        row = self.connection.execute("SELECT * FROM models WHERE path = ?", (os.path.abspath(strFilepath),)).fetchone()
+        return CatalogEntry(*row) if row else None
+
+    def query(self, min_bones=None, max_bones=None, min_vertices=None, max_vertices=None,
+              min_faces=None, max_faces=None, skeleton=None, version=None, texture=None, errors=False):
+        """
+        Returns the entries matching every given filter, ordered by path.
+        Bone counts are angle bones, the bones an imported armature gets.
+        """
+        filters = [("angle_bones >= ?", min_bones), ("angle_bones <= ?", max_bones),
+                   ("vertices >= ?", min_vertices), ("vertices <= ?", max_vertices),
+                   ("faces >= ?", min_faces), ("faces <= ?", max_faces),
+                   ("skeleton = ?", skeleton), ("version = ?", version), ("texture LIKE ?", texture)]
+        clauses = [clause for clause, value in filters if value is not None]
+        values = [value for _, value in filters if value is not None]
+        clauses.append("error IS NOT NULL" if errors else "error IS NULL")
+
+        sql = "SELECT * FROM models WHERE {} ORDER BY path".format(" AND ".join(clauses))
+        return [CatalogEntry(*row) for row in self.connection.execute(sql, values)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m p3m_catalog", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-d", "--database", default=DEFAULT_DATABASE, help="catalog file (default %(default)s)")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    build = commands.add_parser("build", help="add new and changed files, drop deleted ones")
+    build.add_argument("roots", nargs="+", help="files or directories to catalog")
+    build.add_argument("-j", "--jobs", type=int, default=None, help="reader threads")
+
+    query = commands.add_parser("query", help="list the cataloged files matching every filter")
+    query.add_argument("--min-bones", type=int)
+    query.add_argument("--max-bones", type=int)
+    query.add_argument("--min-vertices", type=int)
+    query.add_argument("--max-vertices", type=int)
+    query.add_argument("--min-faces", type=int)
+    query.add_argument("--max-faces", type=int)
+    query.add_argument("--skeleton", help="skeleton fingerprint")
+    query.add_argument("--same-skeleton", metavar="FILE", help="files sharing the skeleton of FILE")
+    query.add_argument("--version", help="exact version string")
+    query.add_argument("--texture", help="texture block, SQL LIKE pattern")
+    query.add_argument("--errors", action="store_true", help="list the files that could not be read instead")
+    args = parser.parse_args(argv)
+
+    with Catalog(args.database) as catalog:
+        if args.command == "build":
+            print(catalog.update(args.roots, args.jobs))
+            return 0
+
+        skeleton = args.skeleton
+        if args.same_skeleton:
+            entry = catalog.get(args.same_skeleton)
+            if entry is None:
+                entry = CatalogEntry(*summarize(os.path.abspath(args.same_skeleton), 0, 0))
+            if entry.error:
+                print("Could not read {}: {}".format(args.same_skeleton, entry.error), file=sys.stderr)
+                return 1
+            skeleton = entry.skeleton
+
+        start = time.perf_counter()
+        entries = catalog.query(args.min_bones, args.max_bones, args.min_vertices, args.max_vertices,
+                                args.min_faces, args.max_faces, skeleton, args.version, args.texture, args.errors)
+        seconds = time.perf_counter() - start
+
+        for entry in entries:
+            if args.errors:
+                print("{}  {}".format(entry.path, entry.error))
+            else:
+                print("{}  {} bones  {} vertices  {} faces  {}".format(
+                    entry.path, entry.angle_bones, entry.vertices, entry.faces, entry.skeleton))
+        print("{} files ({:.1f} ms)".format(len(entries), seconds * 1000.0), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,435 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Binary layout of Perfect 3D Model (.p3m) files.
+
+This module does not depend on bpy so it can be used outside of Blender.
+Every record of the format is described as a NumPy structured dtype and
+each section is decoded with a single np.frombuffer call.
+"""
+
+import hashlib
+import mmap
+import struct
+
+import numpy as np
+
+P3M_VERSION = b"Perfect 3D Model (Ver 0.5)"
+
+VERSION_SIZE = 27       # char[26] version string + 1 byte padding
+TEXTURE_SIZE = 260      # texture name block, kept as raw bytes
+MAX_CHILDREN = 10       # KSafeArray<unsigned char,10> acChildIndex
+NO_CHILD = 255
+NO_BONE = 255
+
+BONE_COUNT = struct.Struct('<2B')
+MESH_COUNT = struct.Struct('<2H')
+
+POSITION_BONE_DTYPE = np.dtype([
+    ('vector', '<f4', (3,)),
+    ('child_index', 'u1', (MAX_CHILDREN,)),
+    ('padding', 'V2'),
+])
+
+ANGLE_BONE_DTYPE = np.dtype([
+    ('vector', '<f4', (3,)),
+    ('scale', '<f4'),
+    ('child_index', 'u1', (MAX_CHILDREN,)),
+    ('padding', 'V2'),
+])
+
+TRIANGLE_DTYPE = np.dtype([
+    ('index', '<u2', (3,)),
+])
+
+SKINVERTEX_DTYPE = np.dtype([
+    ('position', '<f4', (3,)),
+    ('weight', '<f4'),
+    ('bone', 'u1'),
+    ('padding', 'V3'),
+    ('normal', '<f4', (3,)),
+    ('uv', '<f4', (2,)),
+])
+
+assert POSITION_BONE_DTYPE.itemsize == 24
+assert ANGLE_BONE_DTYPE.itemsize == 28
+assert TRIANGLE_DTYPE.itemsize == 6
+assert SKINVERTEX_DTYPE.itemsize == 40
+
+
+class P3MError(ValueError):
+    pass
+
+
+class P3MModel():
+    def __init__(self, version=P3M_VERSION, position_bones=None, angle_bones=None, triangles=None, vertices=None, texture=b''):
+        self.version = version
+        self.texture = texture
+        self.position_bones = position_bones if position_bones is not None else np.zeros(0, POSITION_BONE_DTYPE)
+        self.angle_bones = angle_bones if angle_bones is not None else np.zeros(0, ANGLE_BONE_DTYPE)
+        self.triangles = triangles if triangles is not None else np.zeros(0, TRIANGLE_DTYPE)
+        self.vertices = vertices if vertices is not None else np.zeros(0, SKINVERTEX_DTYPE)
+
+    def __repr__(self):
+        return "P3MModel({!r}, position_bones={}, angle_bones={}, triangles={}, vertices={})".format(
+            self.version, len(self.position_bones), len(self.angle_bones), len(self.triangles), len(self.vertices))
+
+
+def child_lists(child_index):
+    """
+    Converts a (n, 10) child index array into lists, dropping the 255 markers.
+    """
+    return [[int(c) for c in row if c != NO_CHILD] for row in child_index]
+
+
+def skeleton_fingerprint(model):
+    """
+    Hash of the position and angle bone sections. Files with the same
+    fingerprint have byte-identical skeletons.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(BONE_COUNT.pack(len(model.position_bones), len(model.angle_bones)))
+    digest.update(np.ascontiguousarray(model.position_bones).tobytes())
+    digest.update(np.ascontiguousarray(model.angle_bones).tobytes())
+    return digest.hexdigest()
+
+
+class P3MLayout():
+    """
+    Byte offsets of every section, worked out from the header counts.
+    """
+    def __init__(self, version, num_position_bones, num_angle_bones, num_vertices, num_faces):
+        self.version = version
+        self.num_position_bones = num_position_bones
+        self.num_angle_bones = num_angle_bones
+        self.num_vertices = num_vertices
+        self.num_faces = num_faces
+
+        self.position_bones = VERSION_SIZE + BONE_COUNT.size
+        self.angle_bones = self.position_bones + POSITION_BONE_DTYPE.itemsize * num_position_bones
+        self.mesh_count = self.angle_bones + ANGLE_BONE_DTYPE.itemsize * num_angle_bones
+        self.texture = self.mesh_count + MESH_COUNT.size
+        self.triangles = self.texture + TEXTURE_SIZE
+        self.vertices = self.triangles + TRIANGLE_DTYPE.itemsize * num_faces
+        self.size = self.vertices + SKINVERTEX_DTYPE.itemsize * num_vertices
+
+    def section(self, name):
+        return {
+            'position_bones': (POSITION_BONE_DTYPE, self.num_position_bones, self.position_bones),
+            'angle_bones': (ANGLE_BONE_DTYPE, self.num_angle_bones, self.angle_bones),
+            'triangles': (TRIANGLE_DTYPE, self.num_faces, self.triangles),
+            'vertices': (SKINVERTEX_DTYPE, self.num_vertices, self.vertices),
+        }[name]
+
+
+SECTIONS = ('position_bones', 'angle_bones', 'triangles', 'vertices')
+
+
+def read_layout(buffer):
+    """
+    Reads the version string and counts of a P3M file.
+
+    Only the header and the mesh counts are touched; the bone counts give
+    the exact offset of the mesh counts.
+    """
+    if len(buffer) < VERSION_SIZE + BONE_COUNT.size:
+        raise P3MError("Truncated P3M file: missing header")
+
+    strP3MVer = bytes(buffer[:VERSION_SIZE - 1]).rstrip(b'\x00')
+    dwNumPositionBone, dwNumAngleBone = BONE_COUNT.unpack_from(buffer, VERSION_SIZE)
+
+    layout = P3MLayout(strP3MVer, dwNumPositionBone, dwNumAngleBone, 0, 0)
+    if layout.texture > len(buffer):
+        raise P3MError("Truncated P3M file: missing mesh header")
+
+    dwNumVertex, dwNumFace = MESH_COUNT.unpack_from(buffer, layout.mesh_count)
+    layout = P3MLayout(strP3MVer, dwNumPositionBone, dwNumAngleBone, dwNumVertex, dwNumFace)
+    if layout.size > len(buffer):
+        raise P3MError("Truncated P3M file: expected {} bytes, file has {}".format(layout.size, len(buffer)))
+
+    return layout
+
+
+def read_texture(buffer, layout):
+    return bytes(buffer[layout.texture:layout.triangles]).rstrip(b'\x00')
+
+
+def read_section(buffer, layout, name):
+    dtype, count, offset = layout.section(name)
+    return np.frombuffer(buffer, dtype, count, offset)
+
+
+def decode_p3m(buffer):
+    """
+    Decodes a whole P3M file held in a bytes-like object.
+
+    The returned arrays are read-only views into the buffer.
+    """
+    layout = read_layout(buffer)
+    sections = [read_section(buffer, layout, name) for name in SECTIONS]
+    return P3MModel(layout.version, *sections, texture=read_texture(buffer, layout))
+
+
+class P3MReader():
+    """
+    Memory-mapped P3M file.
+
+    The header is parsed on open. Sections are exposed as zero-copy views of
+    the mapping and are only decoded the first time they are accessed, so
+    reading counts from a large file only touches its first pages.
+    """
+    def __init__(self, strFilepath):
+        self.filepath = strFilepath
+        self._file = open(strFilepath, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise P3MError("Truncated P3M file: {} is empty".format(strFilepath))
+        self._sections = {}
+        try:
+            self.layout = read_layout(self._map)
+        except P3MError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._sections.clear()
+        try:
+            self._map.close()
+        except BufferError:
+            # Views handed out are still alive; the mapping is released
+            # once they are garbage collected.
+            pass
+        self._file.close()
+
+    def _section(self, name):
+        if name not in self._sections:
+            self._sections[name] = read_section(self._map, self.layout, name)
+        return self._sections[name]
+
+    @property
+    def version(self):
+        return self.layout.version
+
+    @property
+    def num_position_bones(self):
+        return self.layout.num_position_bones
+
+    @property
+    def num_angle_bones(self):
+        return self.layout.num_angle_bones
+
+    @property
+    def num_vertices(self):
+        return self.layout.num_vertices
+
+    @property
+    def num_faces(self):
+        return self.layout.num_faces
+
+    @property
+    def texture(self):
+        return read_texture(self._map, self.layout)
+
+    @property
+    def position_bones(self):
+        return self._section('position_bones')
+
+    @property
+    def angle_bones(self):
+        return self._section('angle_bones')
+
+    @property
+    def triangles(self):
+        return self._section('triangles')
+
+    @property
+    def vertices(self):
+        return self._section('vertices')
+
+    def to_model(self):
+        """
+        Copies every section out of the mapping so it outlives the reader.
+        """
+        return P3MModel(self.version, *[self._section(name).copy() for name in SECTIONS],
+                        texture=self.texture)
+
+
+def load_p3m(strFilepath):
+    with P3MReader(strFilepath) as reader:
+        return reader.to_model()
+
+
+def pack_child_index(children):
+    """
+    Converts lists of child indices into a (n, 10) array padded with 255.
+    """
+    child_index = np.full((len(children), MAX_CHILDREN), NO_CHILD, dtype=np.uint8)
+    for i, row in enumerate(children):
+        if len(row) > MAX_CHILDREN:
+            raise P3MError("Bone {} has {} children, P3M allows at most {}".format(i, len(row), MAX_CHILDREN))
+        if any(c < 0 or c >= NO_CHILD for c in row):
+            raise P3MError("Bone {} has a child index out of range: {}".format(i, list(row)))
+        child_index[i, :len(row)] = row
+    return child_index
+
+
+def make_position_bones(vectors, children):
+    position_bones = np.zeros(len(children), POSITION_BONE_DTYPE)
+    position_bones['vector'] = np.asarray(vectors, dtype=np.float32).reshape(-1, 3)
+    position_bones['child_index'] = pack_child_index(children)
+    return position_bones
+
+
+def make_angle_bones(children, vectors=None, scales=None):
+    angle_bones = np.zeros(len(children), ANGLE_BONE_DTYPE)
+    if vectors is not None:
+        angle_bones['vector'] = np.asarray(vectors, dtype=np.float32).reshape(-1, 3)
+    angle_bones['scale'] = 1.0 if scales is None else scales
+    angle_bones['child_index'] = pack_child_index(children)
+    return angle_bones
+
+
+def make_triangles(indices):
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1, 3)
+    if len(indices) and (indices.min() < 0 or indices.max() > 0xFFFF):
+        raise P3MError("Triangle indices must fit in 16 bits")
+    triangles = np.zeros(len(indices), TRIANGLE_DTYPE)
+    triangles['index'] = indices
+    return triangles
+
+
+def check_triangles(indices, num_vertices):
+    """
+    Raises P3MError for a triangle using a vertex the mesh does not have.
+    """
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    invalid = np.flatnonzero((indices < 0) | (indices >= num_vertices))
+    if len(invalid):
+        i = int(invalid[0])
+        raise P3MError("Triangle {} uses vertex {}, the mesh has {} vertices".format(
+            i // 3, int(indices[i]), num_vertices))
+
+
+def make_vertices(positions, weights, bones, normals, uvs):
+    bones = np.asarray(bones, dtype=np.int64)
+    if len(bones) and (bones.min() < 0 or bones.max() > 0xFF):
+        raise P3MError("Vertex bone indices must fit in 8 bits")
+    vertices = np.zeros(len(bones), SKINVERTEX_DTYPE)
+    vertices['position'] = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    vertices['weight'] = weights
+    vertices['bone'] = bones
+    vertices['normal'] = np.asarray(normals, dtype=np.float32).reshape(-1, 3)
+    vertices['uv'] = np.asarray(uvs, dtype=np.float32).reshape(-1, 2)
+    return vertices
+
+
+def encode_header(version, num_position_bones, num_angle_bones):
+    if num_position_bones > 0xFF or num_angle_bones > 0xFF:
+        raise P3MError("P3M files hold at most 255 bones of each kind")
+    if len(version) >= VERSION_SIZE:
+        raise P3MError("Version string is too long: {!r}".format(version))
+    return version.ljust(VERSION_SIZE, b'\x00') + BONE_COUNT.pack(num_position_bones, num_angle_bones)
+
+
+def encode_mesh_header(num_vertices, num_faces, texture=b''):
+    if num_vertices > 0xFFFF or num_faces > 0xFFFF:
+        raise P3MError("P3M files hold at most 65535 vertices and faces")
+    if len(texture) > TEXTURE_SIZE:
+        raise P3MError("Texture block is too long: {} bytes".format(len(texture)))
+    return MESH_COUNT.pack(num_vertices, num_faces) + texture.ljust(TEXTURE_SIZE, b'\x00')
+
+
+def encode_sections(model):
+    """
+    Yields the bytes of a P3M file one section at a time.
+    """
+    yield encode_header(model.version, len(model.position_bones), len(model.angle_bones))
+    yield model.position_bones.astype(POSITION_BONE_DTYPE, copy=False).tobytes()
+    yield model.angle_bones.astype(ANGLE_BONE_DTYPE, copy=False).tobytes()
+    yield encode_mesh_header(len(model.vertices), len(model.triangles), model.texture)
+    yield model.triangles.astype(TRIANGLE_DTYPE, copy=False).tobytes()
+    yield model.vertices.astype(SKINVERTEX_DTYPE, copy=False).tobytes()
+
+
+def encode_p3m(model):
+    return b''.join(encode_sections(model))
+
+
+class P3MWriter():
+    """
+    Streams a P3M file to a seekable binary file.
+
+    The header and the bone sections are written up front. Triangles, then
+    vertices, follow in as many chunks as needed and the mesh counts are
+    patched into the header once the writer is closed, so a whole mesh
+    never has to be held in memory.
+
+    with open(strFilepath, 'wb') as file, P3MWriter(file, position_bones, angle_bones) as writer:
+        for chunk in triangle_chunks:
+            writer.write_triangles(chunk)
+        for chunk in vertex_chunks:
+            writer.write_vertices(chunk)
+    """
+    def __init__(self, file, position_bones, angle_bones, version=P3M_VERSION, texture=b''):
+        self.file = file
+        self.num_vertices = 0
+        self.num_faces = 0
+        self.size = 0
+
+        self._write(encode_header(version, len(position_bones), len(angle_bones)))
+        self._write(position_bones.astype(POSITION_BONE_DTYPE, copy=False).tobytes())
+        self._write(angle_bones.astype(ANGLE_BONE_DTYPE, copy=False).tobytes())
+
+        self._mesh_count = file.tell()
+        self._write(encode_mesh_header(0, 0, texture))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+
+    def _write(self, data):
+        written = self.file.write(data)
+        self.size += written
+        return written
+
+    def write_triangles(self, triangles):
+        if self.num_vertices:
+            raise P3MError("Triangles must be written before vertices")
+        if self.num_faces + len(triangles) > 0xFFFF:
+            raise P3MError("P3M files hold at most 65535 vertices and faces")
+        self.num_faces += len(triangles)
+        return self._write(triangles.astype(TRIANGLE_DTYPE, copy=False).tobytes())
+
+    def write_vertices(self, vertices):
+        if self.num_vertices + len(vertices) > 0xFFFF:
+            raise P3MError("P3M files hold at most 65535 vertices and faces")
+        self.num_vertices += len(vertices)
+        return self._write(vertices.astype(SKINVERTEX_DTYPE, copy=False).tobytes())
+
+    def close(self):
+        end = self.file.tell()
+        self.file.seek(self._mesh_count)
+        self.file.write(MESH_COUNT.pack(self.num_vertices, self.num_faces))
+        self.file.seek(end)
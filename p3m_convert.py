@@ -0,0 +1,507 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Batch converter between P3M and glTF, OBJ or JSON, without Blender.
+
+    python -m p3m_convert --to gltf models/ -o converted/
+    python -m p3m_convert --to p3m converted/*.json
+
+JSON is a lossless dump of the P3M tables. glTF keeps the skeleton as a
+skin and the raw P3M tables in extras, so files written by this tool
+convert back exactly up to float rounding. OBJ only carries the mesh.
+
+Meshes are written right handed and Y up: X is mirrored and the triangle
+winding reversed compared to the DirectX data of the P3M file.
+"""
+
+import argparse
+import base64
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import p3m_codec
+import p3m_skeleton
+
+FORMATS = ('p3m', 'json', 'obj', 'gltf')
+
+MIRROR = np.array((-1.0, 1.0, 1.0))
+
+
+def model_to_json(model):
+    return {
+        "version": model.version.decode('ascii', 'replace'),
+        "texture": base64.b64encode(model.texture).decode('ascii'),
+        "position_bones": [
+            {"vector": vector, "children": children}
+            for vector, children in zip(model.position_bones['vector'].tolist(),
+                                        p3m_codec.child_lists(model.position_bones['child_index']))
+        ],
+        "angle_bones": [
+            {"vector": vector, "scale": scale, "children": children}
+            for vector, scale, children in zip(model.angle_bones['vector'].tolist(),
+                                               model.angle_bones['scale'].tolist(),
+                                               p3m_codec.child_lists(model.angle_bones['child_index']))
+        ],
+        "triangles": model.triangles['index'].tolist(),
+        "vertices": {
+            "position": model.vertices['position'].tolist(),
+            "weight": model.vertices['weight'].tolist(),
+            "bone": model.vertices['bone'].tolist(),
+            "normal": model.vertices['normal'].tolist(),
+            "uv": model.vertices['uv'].tolist(),
+        },
+    }
+
+
+def json_to_model(data):
+    position_bones = data.get("position_bones", [])
+    angle_bones = data.get("angle_bones", [])
+    vertices = data.get("vertices", {})
+
+    return p3m_codec.P3MModel(
+        data.get("version", p3m_codec.P3M_VERSION.decode('ascii')).encode('ascii'),
+        p3m_codec.make_position_bones([bone["vector"] for bone in position_bones],
+                                      [bone["children"] for bone in position_bones]),
+        p3m_codec.make_angle_bones([bone["children"] for bone in angle_bones],
+                                   [bone.get("vector", (0.0, 0.0, 0.0)) for bone in angle_bones],
+                                   [bone.get("scale", 1.0) for bone in angle_bones]),
+        p3m_codec.make_triangles(data.get("triangles", [])),
+        p3m_codec.make_vertices(vertices.get("position", []), vertices.get("weight", []),
+                                vertices.get("bone", []), vertices.get("normal", []),
+                                vertices.get("uv", [])),
+        base64.b64decode(data.get("texture", "")),
+    )
+
+
+def unskinned_model(positions, normals, uvs, triangles):
+    """
+    P3M model of a mesh without bones, from right handed data.
+    """
+    count = len(positions)
+    return p3m_codec.P3MModel(
+        p3m_codec.P3M_VERSION,
+        triangles=p3m_codec.make_triangles(np.asarray(triangles).reshape(-1, 3)[:, ::-1]),
+        vertices=p3m_codec.make_vertices(np.asarray(positions).reshape(-1, 3) * MIRROR,
+                                         np.ones(count), np.full(count, p3m_codec.NO_BONE),
+                                         np.asarray(normals).reshape(-1, 3) * MIRROR,
+                                         uvs),
+    )
+
+
+def write_obj(model, strFilepath):
+    skeleton = p3m_skeleton.resolve_skeleton(model.position_bones, model.angle_bones)
+    bones = p3m_skeleton.vertex_bones(model)
+    positions = p3m_skeleton.absolute_positions(model, skeleton, bones) * MIRROR
+    normals = model.vertices['normal'].astype(np.float64) * MIRROR
+    uvs = model.vertices['uv'].astype(np.float64)
+    uvs[:, 1] = 1 - uvs[:, 1]
+    faces = model.triangles['index'].astype(np.int64)[:, ::-1] + 1
+
+    name = os.path.splitext(os.path.basename(strFilepath))[0]
+    lines = ["# Converted from P3M", "o {}".format(name)]
+    lines.extend("v {:.6f} {:.6f} {:.6f}".format(*v) for v in positions.tolist())
+    lines.extend("vt {:.6f} {:.6f}".format(*vt) for vt in uvs.tolist())
+    lines.extend("vn {:.6f} {:.6f} {:.6f}".format(*vn) for vn in normals.tolist())
+    lines.extend("f {0}/{0}/{0} {1}/{1}/{1} {2}/{2}/{2}".format(*f) for f in faces.tolist())
+
+    with open(strFilepath, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+
+
+def read_obj(strFilepath):
+    """
+    Reads the mesh of an OBJ file. P3M holds one UV and normal per vertex, so
+    every distinct v/vt/vn corner becomes a vertex; polygons are fanned into
+    triangles.
+    """
+    positions, uvs, normals = [], [], []
+    corners = {}
+    vertices = []
+    triangles = []
+
+    with open(strFilepath, 'r') as file:
+        for line in file:
+            parts = line.split()
+            if not parts:
+                continue
+            if parts[0] == 'v':
+                positions.append([float(x) for x in parts[1:4]])
+            elif parts[0] == 'vt':
+                uvs.append([float(x) for x in parts[1:3]])
+            elif parts[0] == 'vn':
+                normals.append([float(x) for x in parts[1:4]])
+            elif parts[0] == 'f':
+                face = []
+                for corner in parts[1:]:
+                    indices = (corner.split('/') + ['', ''])[:3]
+                    key = tuple(_obj_index(value, size) for value, size in
+                                zip(indices, (len(positions), len(uvs), len(normals))))
+                    if key not in corners:
+                        corners[key] = len(vertices)
+                        vertices.append(key)
+                    face.append(corners[key])
+                for i in range(1, len(face) - 1):
+                    triangles.append((face[0], face[i], face[i + 1]))
+
+    positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+    uvs = np.array(uvs, dtype=np.float64).reshape(-1, 2)
+    normals = np.array(normals, dtype=np.float64).reshape(-1, 3)
+
+    vertex_positions = np.zeros((len(vertices), 3))
+    vertex_uvs = np.zeros((len(vertices), 2))
+    vertex_normals = np.zeros((len(vertices), 3))
+    for i, (v, vt, vn) in enumerate(vertices):
+        vertex_positions[i] = positions[v]
+        if vt is not None:
+            vertex_uvs[i] = uvs[vt]
+        if vn is not None:
+            vertex_normals[i] = normals[vn]
+    vertex_uvs[:, 1] = 1 - vertex_uvs[:, 1]
+
+    return unskinned_model(vertex_positions, vertex_normals, vertex_uvs, triangles)
+
+
+def _obj_index(value, size):
+    if not value:
+        return None
+    index = int(value)
+    return index - 1 if index > 0 else size + index
+
+
+GLTF_COMPONENT_TYPES = {
+    5120: np.int8, 5121: np.uint8, 5122: np.int16,
+    5123: np.uint16, 5125: np.uint32, 5126: np.float32,
+}
+GLTF_TYPE_WIDTHS = {"SCALAR": 1, "VEC2": 2, "VEC3": 3, "VEC4": 4, "MAT4": 16}
+
+
+class _GLTFBuffer():
+    def __init__(self):
+        self.data = bytearray()
+        self.views = []
+        self.accessors = []
+
+    def add(self, array, gltf_type, target=None, minmax=False):
+        array = np.ascontiguousarray(array)
+        while len(self.data) % 4:
+            self.data.append(0)
+        view = {"buffer": 0, "byteOffset": len(self.data), "byteLength": array.nbytes}
+        if target is not None:
+            view["target"] = target
+        self.data.extend(array.tobytes())
+        self.views.append(view)
+
+        component = {v: k for k, v in GLTF_COMPONENT_TYPES.items()}[array.dtype.type]
+        accessor = {
+            "bufferView": len(self.views) - 1,
+            "componentType": component,
+            "count": len(array),
+            "type": gltf_type,
+        }
+        if minmax and len(array):
+            accessor["min"] = array.min(axis=0).tolist()
+            accessor["max"] = array.max(axis=0).tolist()
+        self.accessors.append(accessor)
+        return len(self.accessors) - 1
+
+
+def write_gltf(model, strFilepath):
+    skeleton = p3m_skeleton.resolve_skeleton(model.position_bones, model.angle_bones)
+    bones = p3m_skeleton.vertex_bones(model)
+    positions = p3m_skeleton.absolute_positions(model, skeleton, bones) * MIRROR
+    heads = skeleton.heads * MIRROR
+
+    buffer = _GLTFBuffer()
+    attributes = {
+        "POSITION": buffer.add(positions.astype(np.float32), "VEC3", 34962, minmax=True),
+        "NORMAL": buffer.add((model.vertices['normal'] * MIRROR).astype(np.float32), "VEC3", 34962),
+        "TEXCOORD_0": buffer.add(model.vertices['uv'].astype(np.float32), "VEC2", 34962),
+        # Custom attributes may not be unsigned ints and must be 4 byte
+        # aligned, a float holds every bone index exactly
+        "_P3M_BONE": buffer.add(model.vertices['bone'].astype(np.float32), "SCALAR", 34962),
+        "_P3M_WEIGHT": buffer.add(model.vertices['weight'].astype(np.float32), "SCALAR", 34962),
+    }
+    indices = model.triangles['index'][:, ::-1].astype(np.uint16).ravel()
+    primitive = {"attributes": attributes, "indices": buffer.add(indices, "SCALAR", 34963)}
+
+    nodes = []
+    scene_nodes = []
+    gltf = {
+        "asset": {"version": "2.0", "generator": "p3m_convert"},
+        "scene": 0,
+        "scenes": [{"nodes": scene_nodes}],
+        "nodes": nodes,
+        "meshes": [{"primitives": [primitive]}],
+    }
+
+    dwNumAngleBone = len(skeleton)
+    if dwNumAngleBone:
+        joints = np.where(bones >= 0, bones, 0).astype(np.uint8)
+        joints4 = np.zeros((len(joints), 4), dtype=np.uint8)
+        joints4[:, 0] = joints
+        weights4 = np.zeros((len(joints), 4), dtype=np.float32)
+        weights4[:, 0] = 1.0
+        attributes["JOINTS_0"] = buffer.add(joints4, "VEC4", 34962)
+        attributes["WEIGHTS_0"] = buffer.add(weights4, "VEC4", 34962)
+
+        for i in range(dwNumAngleBone):
+            parent = skeleton.tree.parents[i]
+            translation = heads[i] - heads[parent] if parent >= 0 else heads[i]
+            node = {"name": "bone_%d" % i, "translation": translation.tolist()}
+            if skeleton.tree.children[i]:
+                node["children"] = list(skeleton.tree.children[i])
+            nodes.append(node)
+
+        inverse_bind = np.tile(np.eye(4, dtype=np.float32), (dwNumAngleBone, 1, 1))
+        inverse_bind[:, 3, :3] = -heads   # column major translation
+        gltf["skins"] = [{
+            "joints": list(range(dwNumAngleBone)),
+            "inverseBindMatrices": buffer.add(inverse_bind.reshape(-1, 16), "MAT4"),
+        }]
+        scene_nodes.extend(skeleton.tree.roots)
+
+    mesh_node = {"name": os.path.splitext(os.path.basename(strFilepath))[0], "mesh": 0}
+    if dwNumAngleBone:
+        mesh_node["skin"] = 0
+    nodes.append(mesh_node)
+    scene_nodes.append(len(nodes) - 1)
+
+    tables = model_to_json(p3m_codec.P3MModel(model.version, model.position_bones, model.angle_bones,
+                                              texture=model.texture))
+    gltf["extras"] = {"p3m": tables}
+
+    gltf["buffers"] = [{
+        "byteLength": len(buffer.data),
+        "uri": "data:application/octet-stream;base64," + base64.b64encode(bytes(buffer.data)).decode('ascii'),
+    }]
+    gltf["bufferViews"] = buffer.views
+    gltf["accessors"] = buffer.accessors
+
+    with open(strFilepath, 'w') as file:
+        json.dump(gltf, file)
+
+
+def _gltf_buffers(gltf, strFilepath):
+    buffers = []
+    for buffer in gltf.get("buffers", []):
+        uri = buffer["uri"]
+        if uri.startswith("data:"):
+            buffers.append(base64.b64decode(uri.split(",", 1)[1]))
+        else:
+            with open(os.path.join(os.path.dirname(strFilepath), uri), 'rb') as file:
+                buffers.append(file.read())
+    return buffers
+
+
+def _gltf_accessor(gltf, buffers, index):
+    accessor = gltf["accessors"][index]
+    view = gltf["bufferViews"][accessor["bufferView"]]
+    dtype = np.dtype(GLTF_COMPONENT_TYPES[accessor["componentType"]])
+    width = GLTF_TYPE_WIDTHS[accessor["type"]]
+    stride = view.get("byteStride") or dtype.itemsize * width
+    offset = view.get("byteOffset", 0) + accessor.get("byteOffset", 0)
+
+    array = np.ndarray((accessor["count"], width), dtype, buffer=buffers[view["buffer"]],
+                       offset=offset, strides=(stride, dtype.itemsize)).copy()
+    return array[:, 0] if width == 1 else array
+
+
+def read_gltf(strFilepath):
+    """
+    Reads the first mesh of a glTF file. Skinning is restored from the P3M
+    tables this tool stores in extras; other files come back unskinned.
+    """
+    with open(strFilepath, 'r') as file:
+        gltf = json.load(file)
+    buffers = _gltf_buffers(gltf, strFilepath)
+
+    positions, normals, uvs, triangles, p3m_bones, p3m_weights = [], [], [], [], [], []
+    count = 0
+    for primitive in gltf["meshes"][0]["primitives"]:
+        attributes = primitive["attributes"]
+        position = _gltf_accessor(gltf, buffers, attributes["POSITION"])
+        n = len(position)
+        positions.append(position)
+        normals.append(_gltf_accessor(gltf, buffers, attributes["NORMAL"]) if "NORMAL" in attributes else np.zeros((n, 3)))
+        uvs.append(_gltf_accessor(gltf, buffers, attributes["TEXCOORD_0"]) if "TEXCOORD_0" in attributes else np.zeros((n, 2)))
+        if "_P3M_BONE" in attributes:
+            p3m_bones.append(_gltf_accessor(gltf, buffers, attributes["_P3M_BONE"]))
+            p3m_weights.append(_gltf_accessor(gltf, buffers, attributes["_P3M_WEIGHT"]))
+        if "indices" in primitive:
+            triangles.append(_gltf_accessor(gltf, buffers, primitive["indices"]).astype(np.int64) + count)
+        else:
+            triangles.append(np.arange(n) + count)
+        count += n
+
+    positions = np.concatenate(positions).astype(np.float64)
+    normals = np.concatenate(normals).astype(np.float64)
+    uvs = np.concatenate(uvs).astype(np.float64)
+    triangles = np.concatenate(triangles).reshape(-1, 3)
+
+    # glTF and DirectX share the top left UV origin
+    model = unskinned_model(positions, normals, uvs, triangles)
+
+    tables = gltf.get("extras", {}).get("p3m")
+    if tables is None or len(p3m_bones) != len(gltf["meshes"][0]["primitives"]):
+        return model
+
+    skinned = json_to_model(tables)
+    skinned.triangles = model.triangles
+    skinned.vertices = model.vertices
+    # Older files store the bone as a byte or an int, newer ones as a float
+    skinned.vertices['bone'] = np.rint(np.concatenate(p3m_bones))
+    skinned.vertices['weight'] = np.concatenate(p3m_weights)
+
+    skeleton = p3m_skeleton.resolve_skeleton(skinned.position_bones, skinned.angle_bones)
+    bones = p3m_skeleton.vertex_bones(skinned)
+    skinned.vertices['position'] = p3m_skeleton.relative_positions(skinned.vertices['position'], skeleton, bones)
+    return skinned
+
+
+def read_model(strFilepath):
+    extension = os.path.splitext(strFilepath)[1].lower()
+    if extension == '.p3m':
+        return p3m_codec.load_p3m(strFilepath)
+    if extension == '.json':
+        with open(strFilepath, 'r') as file:
+            return json_to_model(json.load(file))
+    if extension == '.obj':
+        return read_obj(strFilepath)
+    if extension == '.gltf':
+        return read_gltf(strFilepath)
+    raise p3m_codec.P3MError("Unsupported input format: {}".format(extension))
+
+
+def write_model(model, strFilepath, output_format):
+    if output_format == 'p3m':
+        with open(strFilepath, 'wb') as file:
+            for section in p3m_codec.encode_sections(model):
+                file.write(section)
+    elif output_format == 'json':
+        with open(strFilepath, 'w') as file:
+            json.dump(model_to_json(model), file)
+    elif output_format == 'obj':
+        write_obj(model, strFilepath)
+    elif output_format == 'gltf':
+        write_gltf(model, strFilepath)
+    else:
+        raise p3m_codec.P3MError("Unsupported output format: {}".format(output_format))
+
+
+def convert_file(source, destination, output_format):
+    """
+    Converts one file. Runs in a worker process and never raises, so a
+    broken file only shows up as a failure in the report.
+
+    Returns (source, destination, seconds, error message or None).
+    """
+    start = time.perf_counter()
+    try:
+        model = read_model(source)
+        directory = os.path.dirname(destination)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        write_model(model, destination, output_format)
+    except Exception as error:
+        return source, destination, time.perf_counter() - start, "{}: {}".format(type(error).__name__, error)
+    return source, destination, time.perf_counter() - start, None
+
+
+def collect_inputs(paths, output_format, output_directory):
+    """
+    Expands directories into the convertible files they contain and pairs
+    every input with its destination, keeping the directory layout. No two
+    inputs are given the same destination.
+    """
+    extensions = {'.' + f for f in FORMATS if f != output_format}
+    jobs = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in extensions:
+                        source = os.path.join(root, name)
+                        relative = os.path.relpath(source, path)
+                        jobs.append((source, relative))
+        else:
+            jobs.append((path, os.path.basename(path)))
+
+    destinations = []
+    for source, relative in jobs:
+        base = os.path.join(output_directory, relative) if output_directory else source
+        destinations.append(os.path.splitext(base)[0] + '.' + output_format)
+
+    # Inputs that would land on the same file, such as model.json and
+    # model.obj or two directories with the same layout, get a numeric
+    # suffix instead of overwriting each other in parallel
+    wanted = {_path_key(destination) for destination in destinations}
+    taken = set()
+    pairs = []
+    for (source, _), destination in zip(jobs, destinations):
+        unique = destination
+        suffix = 1
+        while _path_key(unique) in taken or (unique != destination and _path_key(unique) in wanted):
+            suffix += 1
+            base, ext = os.path.splitext(destination)
+            unique = "{}_{}{}".format(base, suffix, ext)
+        if unique != destination:
+            print("{} would share {} with another input, it is written to {} instead".format(
+                source, destination, unique), file=sys.stderr)
+
+        taken.add(_path_key(unique))
+        pairs.append((source, unique))
+    return pairs
+
+
+def _path_key(strFilepath):
+    # Compared ignoring case, like Windows and macOS file systems do
+    return os.path.normcase(os.path.abspath(strFilepath)).lower()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m p3m_convert", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="files or directories to convert")
+    parser.add_argument("--to", dest="output_format", choices=FORMATS, required=True, help="output format")
+    parser.add_argument("-o", "--output", help="output directory, next to the inputs by default")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes, one per core by default")
+    args = parser.parse_args(argv)
+
+    pairs = collect_inputs(args.inputs, args.output_format, args.output)
+    if not pairs:
+        print("Nothing to convert", file=sys.stderr)
+        return 1
+
+    start = time.perf_counter()
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(convert_file, source, destination, args.output_format) for source, destination in pairs]
+        for future in concurrent.futures.as_completed(futures):
+            source, destination, seconds, error = future.result()
+            if error:
+                failures += 1
+                print("FAILED {} ({:.1f} ms): {}".format(source, seconds * 1000.0, error), file=sys.stderr)
+            else:
+                print("{} -> {} ({:.1f} ms)".format(source, destination, seconds * 1000.0))
+
+    print("Converted {} of {} files in {:.2f}s".format(len(pairs) - failures, len(pairs), time.perf_counter() - start))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
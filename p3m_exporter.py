@@ -22,231 +22,839 @@ bl_info = {
     "category": "Import-Export"
 }
 
+import concurrent.futures
+import contextlib
+import hashlib
 import os
-import struct
+import threading
+import time
+from types import SimpleNamespace
 import bpy
+import numpy as np
 from bpy.types import Operator
 from bpy_extras.io_utils import ExportHelper
 
-def removeDuplicates(boneList):
-     #Fix duplicates
-    for i in range(len(boneList)):
-        try:
-            for j in range(i+1, len(boneList)):
-                if boneList[i]['head']['x'] == boneList[j]['head']['x'] and boneList[i]['head']['y'] == boneList[j]['head']['y'] and  boneList[i]['head']['z'] == boneList[j]['head']['z']:
-                    getList = boneList[i]['children_angles']
-                    getList.append(boneList[j]['index'])
-                    boneList[i]['children_angles'] = getList
-                    boneList.remove(boneList[j])
-                    removeDuplicates(boneList)
-        except:
-            break
-    return boneList
+import p3m_codec
+import p3m_optimize
+import p3m_profile
+import p3m_simplify
+import p3m_skeleton
 
+log = p3m_profile.get_logger("exporter")
 
-def export_object(self, context):
+# Triangle corners are welded into one P3M vertex when all of these match
+CORNER_KEY_DTYPE = np.dtype([
+    ('vertex', '<i4'),
+    ('uv', '<f4', (2,)),
+    ('normal', '<f4', (3,)),
+])
+
+# Vertices or faces transformed and written at a time, bounding the size of
+# the temporary arrays whatever the size of the mesh
+EXPORT_CHUNK = 16384
+
+# ExportFile options a watcher keeps, the operator itself does not outlive execute
+WATCH_SETTINGS = ("filepath", "filename_ext", "merge_distance", "optimize_vertex_cache", "vertex_cache_size",
+                  "lod_levels", "lod_ratio", "batch_mode")
+
+# The ExportWatcher of the running watch mode, if any
+watcher = None
+
+
+def removeDuplicates(boneList, epsilon=0.0):
+    """
+    Merges sibling position bones whose heads are at most epsilon apart (or
+    exactly equal when epsilon is 0) in a single pass.
+
+    The first bone of each location keeps its place and collects the angle
+    bone indices of the later ones, in order. Only bones with the same
+    parent are merged, their heads being relative to it.
+
+    Returns the merged bones and the new index of every bone of boneList.
+    """
+    merged = []
+    remap = []
+    by_cell = {}
+    for bone in boneList:
+        head = bone['head']
+        point = (head['x'], head['y'], head['z'])
+
+        first = None
+        if epsilon > 0:
+            # Heads within epsilon are at most one grid cell apart
+            cell = tuple(int(np.floor(c / epsilon)) for c in point)
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for dz in (-1, 0, 1):
+                        key = (bone['parent'], cell[0] + dx, cell[1] + dy, cell[2] + dz)
+                        for index in by_cell.get(key, ()):
+                            other = merged[index]['head']
+                            distance = np.sqrt((other['x'] - point[0]) ** 2 + (other['y'] - point[1]) ** 2
+                                               + (other['z'] - point[2]) ** 2)
+                            if distance <= epsilon and (first is None or index < first):
+                                first = index
+            key = (bone['parent'],) + cell
+        else:
+            key = (bone['parent'],) + point
+            indices = by_cell.get(key)
+            first = indices[0] if indices else None
+
+        if first is None:
+            by_cell.setdefault(key, []).append(len(merged))
+            remap.append(len(merged))
+            merged.append(bone)
+        else:
+            merged[first]['children_angles'].append(bone['index'])
+            remap.append(first)
+
+    return merged, remap
+
+
+def gather_bones(obj):
+    """
+    Returns the world space head of every pose bone of an armature object
+    and the index of each bone's parent (-1 for roots).
+    """
+    pose_bones = obj.pose.bones
+    count = len(pose_bones)
+
+    index = {bone.name: i for i, bone in enumerate(pose_bones)}
+    parents = [index[bone.parent.name] if bone.parent else -1 for bone in pose_bones]
+
+    # foreach_get flattens matrices column by column
+    matrices = np.empty(count * 16, dtype=np.float32)
+    pose_bones.foreach_get("matrix", matrices)
+    matrices = matrices.reshape(count, 4, 4).transpose(0, 2, 1).astype(np.float64)
+
+    locations = np.empty(count * 3, dtype=np.float32)
+    pose_bones.foreach_get("location", locations)
+    locations = locations.reshape(count, 3).astype(np.float64)
+
+    # (matrix_world @ bone.matrix) @ bone.location for every bone at once
+    matrices = np.array(obj.matrix_world, dtype=np.float64) @ matrices
+    heads = np.einsum('nij,nj->ni', matrices[:, :3, :3], locations) + matrices[:, :3, 3]
+
+    return heads, parents
+
+
+def gather_weights(mesh):
+    """
+    Returns the dominant bone and its weight for every vertex of a mesh.
+
+    P3M vertices carry a single influence: the vertex group with the highest
+    weight wins and the lowest group index breaks ties. Vertices outside of
+    every group are bound to bone 0 with a weight of 1.
+    """
+    count = len(mesh.vertices)
+    bones = np.zeros(count, dtype=np.int32)
+    weights = np.ones(count, dtype=np.float32)
+
+    for vertex in mesh.vertices:
+        best_group = -1
+        best_weight = 0.0
+        for element in vertex.groups:
+            group = element.group
+            weight = element.weight
+            if best_group < 0 or weight > best_weight or (weight == best_weight and group < best_group):
+                best_group = group
+                best_weight = weight
+
+        if best_group >= 0:
+            bones[vertex.index] = best_group
+            weights[vertex.index] = best_weight
+
+    return bones, weights
+
+
+def gather_triangles(mesh):
+    """
+    Returns the loop indices of the triangles of a mesh, triangulating its
+    polygons through loop_triangles.
+    """
+    mesh.calc_loop_triangles()
+    loops = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+    mesh.loop_triangles.foreach_get("loops", loops)
+    return loops.reshape(-1, 3)
+
+
+def gather_loops(mesh):
+    """
+    Returns the vertex index, UV and normal of every loop (face corner) of
+    a mesh. UVs are flipped to DirectX's top left origin on a copy, the
+    mesh's own UV layer is left untouched.
+    """
+    count = len(mesh.loops)
+    loop_vertices = np.empty(count, dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+
+    loop_uvs = np.zeros(count * 2, dtype=np.float32)
+    if mesh.uv_layers.active is not None:
+        mesh.uv_layers.active.data.foreach_get("uv", loop_uvs)
+    loop_uvs = loop_uvs.reshape(count, 2)
+    loop_uvs[:, 1] = 1 - loop_uvs[:, 1]
+
+    if hasattr(mesh, "calc_normals_split"):
+        # Blender < 4.1 only fills the loop normals on request
+        mesh.calc_normals_split()
+    loop_normals = np.empty(count * 3, dtype=np.float32)
+    mesh.loops.foreach_get("normal", loop_normals)
+
+    return loop_vertices, loop_uvs, loop_normals.reshape(count, 3)
+
+
+def split_vertices(triangle_loops, loop_vertices, loop_uvs, loop_normals):
+    """
+    Welds the triangle corners into P3M vertices.
+
+    P3M vertices hold a single UV and normal, so corners sharing a Blender
+    vertex only share a P3M vertex when their UV and normal match as well:
+    vertices are split along UV seams and sharp edges, and nowhere else.
+
+    Returns the loop each P3M vertex is taken from, in order of first use,
+    and the triangles as indices into those vertices.
+    """
+    corners = triangle_loops.ravel()
+
+    keys = np.zeros(len(corners), dtype=CORNER_KEY_DTYPE)
+    keys['vertex'] = loop_vertices[corners]
+    # + 0.0 turns -0.0 into 0.0 so both weld
+    keys['uv'] = loop_uvs[corners] + 0.0
+    keys['normal'] = loop_normals[corners] + 0.0
+
+    # Equal keys have equal bytes, so the records are compared as opaque blobs
+    blobs = keys.view(np.dtype((np.void, CORNER_KEY_DTYPE.itemsize)))
+    _, first, inverse = np.unique(blobs, return_index=True, return_inverse=True)
+
+    # np.unique sorts by key, renumber by first use instead
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    return corners[first[order]], rank[inverse.ravel()].reshape(-1, 3)
+
+
+def gather_positions(mesh):
+    """
+    Returns the local position of every vertex of a mesh.
+    """
+    count = len(mesh.vertices)
+    co = np.empty(count * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    return co.reshape(count, 3)
+
+
+def fingerprint(*arrays):
+    """
+    Digest of the shape, type and content of arrays, to tell whether
+    gathered data changed.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update("{}{}".format(array.dtype.str, array.shape).encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_write(strFilepath):
+    """
+    Opens a temporary file next to strFilepath and moves it over
+    strFilepath once it is complete, so a game client reloading the file
+    never reads a partial one. The temporary file is removed on failure.
+    """
+    # Unique per thread, so batch workers never share one. Opened like the
+    # target would be, a NamedTemporaryFile would leave the export at 0600
+    strTempFilepath = "{}.{}.{}.tmp".format(strFilepath, os.getpid(), threading.get_ident())
+    try:
+        with open(strTempFilepath, 'wb') as file:
+            yield file
+        os.replace(strTempFilepath, strFilepath)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(strTempFilepath)
+        raise
+
+
+def chunks(count):
+    for start in range(0, count, EXPORT_CHUNK):
+        yield start, min(start + EXPORT_CHUNK, count)
+
+
+def make_vertex_chunk(matrix, co, normals, uvs, bones, weights, bone_heads, num_position_bones):
+    """
+    Turns a chunk of local vertex data into P3M vertex records.
+
+    Positions are moved to world space, swapped to Y up, made relative to
+    the head of their bone and mirrored on X. Without any bone the vertices
+    are written unskinned, in absolute coordinates.
+    """
+    world = co @ matrix[:3, :3].T + matrix[:3, 3]
+    if len(bone_heads):
+        positions = world[:, (0, 2, 1)] - bone_heads[bones]
+        bones = bones + num_position_bones
+    else:
+        positions = world[:, (0, 2, 1)]
+        bones = np.full(len(bones), p3m_codec.NO_BONE)
+    positions[:, 0] = np.where(positions[:, 0] != 0, -positions[:, 0], 0.0)
+
+    # Same as matrix_world @ normal
+    normals = normals @ matrix[:3, :3].T + matrix[:3, 3]
+
+    return p3m_codec.make_vertices(positions, weights, bones, normals, uvs)
+
+
+class GatheredSkeleton():
+    """
+    Bone sections of one or more armatures, ready to be written, and the
+    absolute bone heads the vertices are made relative to.
+    """
+    def __init__(self, position_bones, angle_bones, bone_heads):
+        self.position_bones = position_bones
+        self.angle_bones = angle_bones
+        self.bone_heads = bone_heads
+
+
+class GatheredMesh():
+    """
+    Everything needed to write a mesh object, read from bpy on the main
+    thread. Vertex data is indexed by P3M vertex, except co, bones and
+    weights which are indexed by the Blender vertex in `vertices`.
+    """
+    def __init__(self, name, matrix, faces, vertices, uvs, normals, co, bones, weights):
+        self.name = name
+        self.matrix = matrix
+        self.faces = faces
+        self.vertices = vertices
+        self.uvs = uvs
+        self.normals = normals
+        self.co = co
+        self.bones = bones
+        self.weights = weights
+
+
+def gather_skeleton(armatures, merge_distance, timer):
     bones_position = []
     bones_children = []
-    faces = []
-    vertices = []
-
-    for obj in bpy.data.objects:
-        if obj.type == 'ARMATURE':
-            print("---------- ARMATURE ----------")
-            bone_count = 0
-            ang_bone_chk = 0
-            for bone in obj.pose.bones:
-                print("Exporting " + bone.name + "...")
+    bone_heads = []
 
-                # Initialize bones children array
-                bones_children.append([])
+    for obj in armatures:
+        log.info("Exporting armature %s", obj.name)
+        with timer.phase("skeleton", len(obj.pose.bones), "bones"):
+            heads, parents = gather_bones(obj)
 
-                # Multiply position by the world matrix
-                obj_bone_matrix = obj.matrix_world @ bone.matrix
-                global_location = obj_bone_matrix @ bone.location
+            base = len(bones_position)
+            bones_children.extend([] for _ in parents)
 
+            for bone_count, ((x, y, z), parent_index) in enumerate(zip(heads.tolist(), parents)):
                 # Get bone head position
-                temp = {
-                    "index": bone_count,
-                    "head": {"x": global_location[0], "y": global_location[2], "z": global_location[1]},
-                    "children_angles": [bone_count]
-                }
-                bones_position.append(temp)
-
-                # Check if bone has parent
-                parent_count = 0
-                parent_index = -1
-                for b in obj.pose.bones:
-                    if bone.parent == b:
-                        parent_index = parent_count
-                        break
-                    parent_count += 1
-
-                bones_position[bone_count]['parent'] = parent_index
-
-                ang_indexX = bones_position[bone_count]['head']['x']
-                ang_indexY = bones_position[bone_count]['head']['y']
-                ang_indexZ = bones_position[bone_count]['head']['z']
-                if ang_indexX == 0.0 and ang_indexY == 0.0 and ang_indexZ == 0.0 and bone_count > 0:
-                    ang_bone_chk += 1
-
+                bones_position.append({
+                    "index": base + bone_count,
+                    "head": {"x": x, "y": z, "z": y},
+                    "children_angles": [base + bone_count],
+                    "parent": base + parent_index if parent_index >= 0 else -1
+                })
+                bone_heads.append((x, z, y))
+
+                # Position bone of the child, until bones are merged
                 if parent_index >= 0:
-                    bones_children[parent_index].append(bone_count - ang_bone_chk)
-
-                
-
-                #print(bones_position[bone_count])
-                #print(bones_children[parent_index])
-                bone_count += 1
-        
-            #print(bones_position)
-            #print(bones_children)
-        elif obj.type == 'MESH':
-            print("\n---------- MESH ----------")
-            print("Exporting vertices...")
-            print(len(obj.data.vertices))
-            for vertex in obj.data.vertices:
-                v_pos = obj.matrix_world @ vertex.co
-                #v_pos[0] = v_pos[0] * -1 if v_pos[0] != 0 else 0
-
-                v_nor = obj.matrix_world @ vertex.normal
-
-                temp = {
-                    "weight": vertex.groups[0].weight if len(vertex.groups) > 0 else 1,
-                    "position": {"x": v_pos[0], "y": v_pos[2], "z": v_pos[1]},
-                    "normal": {"x": v_nor[0], "y": v_nor[1], "z": v_nor[2]},
-                    "texture": {"u": 0, "v": 0},
-                    "bone": 0
-                }
-
-                #print(temp)
-                #print(v_nor)
-
-                vertices.append(temp)
-
-            print("Exporting faces...")
-            for loop in range(len(obj.data.loops)):
-                if loop % 3 == 0:
-                    if loop + 2 < len(obj.data.loops):
-                        face = {"a": obj.data.loops[loop].vertex_index, "b": obj.data.loops[loop + 1].vertex_index, "c": obj.data.loops[loop + 2].vertex_index}
-                        faces.append(face)
-
-            print("Exporting vertex groups...")
-            for group in obj.vertex_groups:
-                vs = [v for v in obj.data.vertices if group.index in [vg.group for vg in v.groups]]
-                for v in vs:
-                    vertices[v.index]['bone'] = group.index
-
-            print("Exporting UVs...")
-            for face in obj.data.polygons:
-                for vert_idx, loop_idx in zip(face.vertices, face.loop_indices):
-                    uv_coords = obj.data.uv_layers.active.data[loop_idx].uv
-                    uv_coords.y = 1 - uv_coords.y
-                    vertices[vert_idx]["texture"] = {"u": uv_coords.x, "v": uv_coords.y}
-
-    # Put vertices to right location
-    for vertex in vertices:
-        if 'bone' in vertex:
-            bone = vertex['bone']
-
-            vertex['position']['x'] = vertex['position']['x'] - bones_position[bone]['head']['x']
-            vertex['position']['y'] = vertex['position']['y'] - bones_position[bone]['head']['y']
-            vertex['position']['z'] = vertex['position']['z'] - bones_position[bone]['head']['z']
-
-            vertex['position']['x'] = vertex['position']['x'] * -1 if vertex['position']['x'] != 0 else 0
-    
-
-    # Put bones head to right location
-    for bone in reversed(bones_position):
-        if bone['parent'] != -1:
-            parent = bones_position[bone['parent']]
-
-            bone['head']['x'] = float(bone['head']['x']) - float(parent['head']['x'])
-            bone['head']['y'] = float(bone['head']['y']) - float(parent['head']['y'])
-            bone['head']['z'] = float(bone['head']['z']) - float(parent['head']['z'])
-
-            bone['head']['x'] = bone['head']['x'] * -1 if bone['head']['x'] != 0 else 0
-
-    bones_position = removeDuplicates(bones_position)
-
-    
-    #print(bones_position)
-    #print(vertices)
-
-    with open(self.filepath, 'wb') as file:
-        print("\n---------- WRITING TO FILE ----------")
-        file.write("Perfect 3D Model (Ver 0.5)".encode("ascii") + b'\x00')
-
-        print("Writing bones...")
-        print(len(bones_position))
-        print(len(bones_children))
-        file.write(struct.pack('<B', len(bones_position)))
-        file.write(struct.pack('<B', len(bones_children)))
-
-        for bone in range(len(bones_position)):
-            file.write(struct.pack('<f', bones_position[bone]['head']['x']))
-            file.write(struct.pack('<f', bones_position[bone]['head']['y']))
-            file.write(struct.pack('<f', bones_position[bone]['head']['z']))
-
-            chIndex = 10
-            getList = bones_position[bone]['children_angles']
-            for i in getList:
-                file.write(struct.pack('<B', i))
-                chIndex -= 1
-            
-            for i in range(chIndex):
-                 file.write(b'\xff')
-
-            file.write(b'\x00\x00')  # add padding
-
-        for x in range(len(bones_children)):
-            file.write(b'\x00\x00\x00\x00')
-            file.write(b'\x00\x00\x00\x00')
-            file.write(b'\x00\x00\x00\x00')
-            file.write(b'\x00\x00\x80\x3f')
-
-            for _ in range(10):
-                if _ < len(bones_children[x]):
-                    file.write(struct.pack('<B', bones_children[x][_]))
-                else:
-                    file.write(b'\xff')
-
-            file.write(struct.pack('<2x'))
-
-        print("Writing mesh...")
-        file.write(struct.pack('<H', len(vertices)))
-        file.write(struct.pack('<H', len(faces)))
-
-        file.write(struct.pack('<260x'))
-
-        print(faces)
-        print("Writing faces...")
-        for x in range(len(faces)):
-            file.write(struct.pack('<H', faces[x]['a']))
-            file.write(struct.pack('<H', faces[x]['b']))
-            file.write(struct.pack('<H', faces[x]['c']))
-
-        print(vertices)
-        print("Writing vertices...")
-        for x in range(len(vertices)):
-            position = vertices[x]['position']
-            weight = vertices[x]['weight']
-            bone = vertices[x]['bone'] + len(bones_position)
-            normal = vertices[x]['normal']
-            texture = vertices[x]['texture']
-
-            file.write(struct.pack('<3f', position['x'], position['y'], position['z']))
-            file.write(struct.pack('<f', weight))
-            file.write(struct.pack('<B', bone))
-            file.write(struct.pack('<3x'))  # padding
-            file.write(struct.pack('<3f', normal['x'], normal['y'], normal['z']))
-            file.write(struct.pack('<2f', texture['u'], texture['v']))
-
-        file.close()
+                    bones_children[base + parent_index].append(base + bone_count)
+
+    # Vertices are made relative to the absolute heads
+    bone_heads = np.array(bone_heads, dtype=np.float64).reshape(-1, 3)
+
+    with timer.phase("transform", len(bones_position), "bones"):
+        # Put bones head to right location, children first so every parent
+        # head is still absolute when it is subtracted
+        tree = p3m_skeleton.BoneTree([bone['parent'] for bone in bones_position])
+        for i in reversed(tree.order):
+            bone = bones_position[i]
+            if bone['parent'] != -1:
+                parent = bones_position[bone['parent']]
+
+                bone['head']['x'] = float(bone['head']['x']) - float(parent['head']['x'])
+                bone['head']['y'] = float(bone['head']['y']) - float(parent['head']['y'])
+                bone['head']['z'] = float(bone['head']['z']) - float(parent['head']['z'])
+
+                bone['head']['x'] = bone['head']['x'] * -1 if bone['head']['x'] != 0 else 0
+
+        bones_position, remap = removeDuplicates(bones_position, merge_distance)
+
+        # Children merged into one position bone are listed once
+        bones_children = [list(dict.fromkeys(remap[child] for child in children)) for children in bones_children]
+
+    with timer.phase("encode", len(bones_position) + len(bones_children), "records"):
+        position_bones = p3m_codec.make_position_bones(
+            [(bone['head']['x'], bone['head']['y'], bone['head']['z']) for bone in bones_position],
+            [bone['children_angles'] for bone in bones_position])
+        angle_bones = p3m_codec.make_angle_bones(bones_children)
+
+    return GatheredSkeleton(position_bones, angle_bones, bone_heads)
+
+
+def gather_mesh(self, obj, timer, sections=None):
+    """
+    Reads a mesh object from bpy. With a SectionCache, the split and
+    optimized vertices are reused as long as the triangles, UVs and normals
+    they are made from are unchanged.
+    """
+    mesh = obj.data
+    log.info("Exporting mesh %s (%d vertices)", obj.name, len(mesh.vertices))
+
+    with timer.phase("mesh", unit="faces") as phase:
+        log.debug("Exporting faces...")
+        triangle_loops = gather_triangles(mesh)
+        loop_vertices, loop_uvs, loop_normals = gather_loops(mesh)
+        co = gather_positions(mesh)
+        phase.count = len(triangle_loops)
+
+    cached = None
+    if sections is not None:
+        key = fingerprint(triangle_loops, loop_vertices, loop_uvs, loop_normals)
+        cached = sections.get(obj.name, "split", key)
+
+    if cached is not None:
+        corners, faces = cached
+    else:
+        with timer.phase("split", len(triangle_loops) * 3, "corners"):
+            corners, faces = split_vertices(triangle_loops, loop_vertices, loop_uvs, loop_normals)
+            log.debug("%d vertices split into %d", len(mesh.vertices), len(corners))
+
+        if self.optimize_vertex_cache:
+            with timer.phase("optimize", len(faces), "faces"):
+                faces, order, before, after = p3m_optimize.optimize_faces(faces, len(corners), self.vertex_cache_size)
+                corners = corners[order]
+            log.info("%s: ACMR %.3f -> %.3f, ATVR %.3f -> %.3f",
+                     obj.name, before.acmr, after.acmr, before.atvr, after.atvr)
+
+        if sections is not None:
+            sections.store(obj.name, "split", key, (corners, faces))
+
+    with timer.phase("skinning", len(mesh.vertices), "vertices"):
+        log.debug("Exporting vertex groups...")
+        vertex_bones, vertex_weights = gather_weights(mesh)
+
+    return GatheredMesh(obj.name, np.array(obj.matrix_world, dtype=np.float64), faces,
+                        loop_vertices[corners], loop_uvs[corners], loop_normals[corners],
+                        co, vertex_bones, vertex_weights)
+
+
+def write_p3m(strFilepath, skeleton, meshes, timer):
+    """
+    Streams gathered meshes to a P3M file EXPORT_CHUNK records at a time,
+    the triangles of every mesh before any vertex. Does not touch bpy, so
+    it can run on a worker thread.
+    """
+    num_position_bones = len(skeleton.position_bones)
+
+    with atomic_write(strFilepath) as file, \
+            p3m_codec.P3MWriter(file, skeleton.position_bones, skeleton.angle_bones) as writer:
+        base = 0
+        for mesh in meshes:
+            for start, stop in chunks(len(mesh.faces)):
+                with timer.phase("encode", stop - start, "records"):
+                    triangles = p3m_codec.make_triangles(mesh.faces[start:stop] + base)
+                with timer.phase("write", unit="bytes") as phase:
+                    phase.count = writer.write_triangles(triangles)
+            base += len(mesh.vertices)
+
+        for mesh in meshes:
+            for start, stop in chunks(len(mesh.vertices)):
+                with timer.phase("encode", stop - start, "records"):
+                    vertices = mesh.vertices[start:stop]
+                    records = make_vertex_chunk(mesh.matrix, mesh.co[vertices], mesh.normals[start:stop],
+                                                mesh.uvs[start:stop], mesh.bones[vertices], mesh.weights[vertices],
+                                                skeleton.bone_heads, num_position_bones)
+                with timer.phase("write", unit="bytes") as phase:
+                    phase.count = writer.write_vertices(records)
+
+    log.info("Wrote %d position bones, %d angle bones, %d vertices and %d faces to %s",
+             num_position_bones, len(skeleton.angle_bones), writer.num_vertices, writer.num_faces,
+             os.path.basename(strFilepath))
+    return writer
+
+
+def export_candidates(self, context):
+    return list(context.selected_objects) if self.selected_only else list(bpy.data.objects)
+
+
+def export_object(self, context):
+    """
+    Writes every armature and mesh of the scene, or of the selection, to a
+    single P3M file.
+    """
+    timer = p3m_profile.PhaseTimer("Exported {}".format(os.path.basename(self.filepath)))
+
+    objects = export_candidates(self, context)
+    skeleton = gather_skeleton([obj for obj in objects if obj.type == 'ARMATURE'], self.merge_distance, timer)
+    meshes = [gather_mesh(self, obj, timer) for obj in objects if obj.type == 'MESH']
+
+    write_p3m(self.filepath, skeleton, meshes, timer)
+
+    if self.lod_levels > 0:
+        export_lods(self.filepath, self.lod_levels, self.lod_ratio,
+                    self.vertex_cache_size if self.optimize_vertex_cache else None, timer)
+
+    log.info("%s", timer.report())
 
     return {'FINISHED'}
 
 
+def mesh_armature(obj):
+    """
+    Returns the armature object deforming a mesh object: the one of its
+    Armature modifier, else its parent if that is an armature.
+    """
+    for modifier in obj.modifiers:
+        if modifier.type == 'ARMATURE' and modifier.object is not None:
+            return modifier.object
+    if obj.parent is not None and obj.parent.type == 'ARMATURE':
+        return obj.parent
+    return None
+
+
+def batch_filepaths(meshes, directory, ext):
+    """
+    Output path of every mesh object in batch mode, named after the mesh.
+    Names that clean up to the same file name, such as Sword.L and Sword_L,
+    get a numeric suffix so no two meshes are written to one file. Names
+    are compared ignoring case, like Windows and macOS file systems do.
+    """
+    strFilepaths = []
+    taken = set()
+    for obj in meshes:
+        name = bpy.path.clean_name(obj.name)
+        unique = name
+        suffix = 1
+        while (unique + ext).lower() in taken:
+            suffix += 1
+            unique = "{}_{}".format(name, suffix)
+        if unique != name:
+            log.warning("%s would share %s with another mesh, it is written to %s instead",
+                        obj.name, name + ext, unique + ext)
+
+        taken.add((unique + ext).lower())
+        strFilepaths.append(os.path.join(directory, unique + ext))
+    return strFilepaths
+
+
+def batch_failure(failures, strFilepath, error):
+    # Broken files are expected in a batch, anything else gets a traceback
+    expected = isinstance(error, (OSError, p3m_codec.P3MError))
+    log.error("Could not export %s: %s", strFilepath, error, exc_info=not expected)
+    failures.append((strFilepath, error))
+
+
+def export_batch(self, context):
+    """
+    Writes one P3M file per mesh object, with the armature deforming it,
+    next to self.filepath and named after the mesh.
+
+    Objects are read from bpy on the main thread while a thread pool
+    encodes and writes the files gathered so far. An object that fails for
+    any reason is reported and skipped, the others are still written.
+    Returns the number of files attempted and the list of (filepath,
+    error) of the files that failed.
+    """
+    directory = os.path.dirname(self.filepath)
+    ext = os.path.splitext(self.filepath)[1] or self.filename_ext
+
+    # Operator properties are only read on the main thread
+    lod_levels = self.lod_levels
+    lod_ratio = self.lod_ratio
+    lod_cache_size = self.vertex_cache_size if self.optimize_vertex_cache else None
+
+    def write_file(strFilepath, skeleton, mesh, timer):
+        write_p3m(strFilepath, skeleton, [mesh], timer)
+        if lod_levels > 0:
+            export_lods(strFilepath, lod_levels, lod_ratio, lod_cache_size, timer)
+        return timer
+
+    meshes = [obj for obj in export_candidates(self, context) if obj.type == 'MESH']
+    skeletons = {}
+    failures = []
+
+    workers = max(min(len(meshes), os.cpu_count() or 1), 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for obj, strFilepath in zip(meshes, batch_filepaths(meshes, directory, ext)):
+            timer = p3m_profile.PhaseTimer("Exported {}".format(os.path.basename(strFilepath)))
+
+            try:
+                armature = mesh_armature(obj)
+                if armature is None:
+                    log.warning("%s has no armature, it is exported unskinned", obj.name)
+                key = armature.name if armature is not None else None
+                if key not in skeletons:
+                    skeletons[key] = gather_skeleton([armature] if armature is not None else [],
+                                                     self.merge_distance, timer)
+
+                mesh = gather_mesh(self, obj, timer)
+            except Exception as error:
+                batch_failure(failures, strFilepath, error)
+                continue
+            futures[pool.submit(write_file, strFilepath, skeletons[key], mesh, timer)] = strFilepath
+
+        for future in concurrent.futures.as_completed(futures):
+            strFilepath = futures[future]
+            try:
+                timer = future.result()
+            except Exception as error:
+                batch_failure(failures, strFilepath, error)
+                continue
+            log.info("%s", timer.report())
+
+    return len(meshes), failures
+
+
+def export_lods(strFilepath, lod_levels, lod_ratio, vertex_cache_size, timer):
+    """
+    Writes lod_levels simplified copies of an exported file next to it,
+    as <name>_lod1.p3m, <name>_lod2.p3m and so on. With a vertex_cache_size
+    every level is optimized for the vertex cache.
+    """
+    model = p3m_codec.load_p3m(strFilepath)
+    root, ext = os.path.splitext(strFilepath)
+
+    with timer.phase("lod", len(model.triangles), "faces"):
+        chain = p3m_simplify.lod_chain(model, lod_levels, lod_ratio)
+
+    for lod in chain:
+        lod_model = lod.model
+        if vertex_cache_size is not None:
+            with timer.phase("optimize", len(lod_model.triangles), "faces"):
+                faces, order, _, _ = p3m_optimize.optimize_faces(
+                    lod_model.triangles['index'], len(lod_model.vertices), vertex_cache_size)
+                lod_model = p3m_codec.P3MModel(lod_model.version, lod_model.position_bones, lod_model.angle_bones,
+                                               p3m_codec.make_triangles(faces), lod_model.vertices[order],
+                                               lod_model.texture)
+
+        strLodFilepath = "{}_lod{}{}".format(root, lod.level, ext)
+        with timer.phase("write", unit="bytes") as phase:
+            phase.count = 0
+            with atomic_write(strLodFilepath) as file:
+                for section in p3m_codec.encode_sections(lod_model):
+                    phase.count += file.write(section)
+
+        log.info("LOD %d: %d faces (%.1f%%), %d vertices, RMS error %.6f, written to %s",
+                 lod.level, len(lod_model.triangles), 100.0 * len(lod_model.triangles) / max(len(model.triangles), 1),
+                 len(lod_model.vertices), lod.error, os.path.basename(strLodFilepath))
+
+
+class SectionCache():
+    """
+    Gathered sections kept by object name and section name, each with the
+    fingerprint of the data it was made from.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, name, section, key):
+        entry = self.entries.get((name, section))
+        if entry is None or entry[0] != key:
+            return None
+        return entry[1]
+
+    def store(self, name, section, key, value):
+        self.entries[(name, section)] = (key, value)
+
+    def prune(self, names):
+        """
+        Drops the sections of the objects that are not in names anymore.
+        """
+        self.entries = {(name, section): entry for (name, section), entry in self.entries.items() if name in names}
+
+
+class ExportWatcher():
+    """
+    Exports again whenever the scene changes, with the options ExportFile
+    was run with.
+
+    Depsgraph updates only mark objects as dirty. Once no update has come
+    for `delay` seconds, the dirty objects are gathered again, reusing the
+    sections whose fingerprint did not change, and only the files whose
+    content changed are rewritten.
+    """
+    def __init__(self, settings, object_names=None, delay=0.5):
+        self.settings = settings
+        # None follows every object of the blend file
+        self.object_names = object_names
+        self.delay = delay
+
+        self.sections = SectionCache()
+        self.meshes = {}
+        self.skeletons = {}
+        self.written = {}
+
+        self.dirty_objects = set()
+        self.dirty_data = set()
+        self.everything_dirty = True
+        self.deadline = 0.0
+
+        # Handlers and timers are looked up by identity, a bound method is
+        # a new object on every access
+        self.handler = self.on_depsgraph_update
+        self.timer = self.on_timer
+
+    def start(self, context):
+        self.flush(context)
+        bpy.app.handlers.depsgraph_update_post.append(self.handler)
+
+    def stop(self):
+        if self.handler in bpy.app.handlers.depsgraph_update_post:
+            bpy.app.handlers.depsgraph_update_post.remove(self.handler)
+        if bpy.app.timers.is_registered(self.timer):
+            bpy.app.timers.unregister(self.timer)
+
+    def on_depsgraph_update(self, scene, depsgraph):
+        for update in depsgraph.updates:
+            changed = update.id.original
+            if isinstance(changed, bpy.types.Object):
+                self.dirty_objects.add(changed.name)
+            else:
+                self.dirty_data.add(changed.name)
+
+        # Debounce: every update pushes the export back
+        self.deadline = time.monotonic() + self.delay
+        if not bpy.app.timers.is_registered(self.timer):
+            bpy.app.timers.register(self.timer, first_interval=self.delay)
+
+    def on_timer(self):
+        remaining = self.deadline - time.monotonic()
+        if remaining > 0:
+            return remaining
+
+        # Edits only reach the mesh once edit mode is left
+        active = bpy.context.active_object
+        if active is not None and active.mode == 'EDIT':
+            return self.delay
+
+        try:
+            self.flush(bpy.context)
+        except (OSError, p3m_codec.P3MError) as error:
+            log.error("Could not export %s: %s", self.settings.filepath, error)
+            self.everything_dirty = True
+        return None
+
+    def is_dirty(self, obj):
+        return (self.everything_dirty or obj.name in self.dirty_objects
+                or (obj.data is not None and obj.data.name in self.dirty_data))
+
+    def candidates(self):
+        if self.object_names is None:
+            return list(bpy.data.objects)
+        objects = (bpy.data.objects.get(name) for name in self.object_names)
+        return [obj for obj in objects if obj is not None]
+
+    def jobs(self, objects):
+        """
+        Returns the (filepath, armatures, meshes) of every file to write.
+        """
+        settings = self.settings
+        meshes = [obj for obj in objects if obj.type == 'MESH']
+        if not settings.batch_mode:
+            return [(settings.filepath, [obj for obj in objects if obj.type == 'ARMATURE'], meshes)]
+
+        directory = os.path.dirname(settings.filepath)
+        ext = os.path.splitext(settings.filepath)[1] or settings.filename_ext
+        jobs = []
+        for obj, strFilepath in zip(meshes, batch_filepaths(meshes, directory, ext)):
+            armature = mesh_armature(obj)
+            jobs.append((strFilepath, [armature] if armature is not None else [], [obj]))
+        return jobs
+
+    def gather_skeleton(self, armatures, timer):
+        names = tuple(obj.name for obj in armatures)
+        cached = self.skeletons.get(names)
+        if cached is None or any(self.is_dirty(obj) for obj in armatures):
+            skeleton = gather_skeleton(armatures, self.settings.merge_distance, timer)
+            cached = (fingerprint(skeleton.position_bones, skeleton.angle_bones, skeleton.bone_heads), skeleton)
+            self.skeletons[names] = cached
+        return cached
+
+    def gather_mesh(self, obj, timer):
+        cached = self.meshes.get(obj.name)
+        if cached is None or self.is_dirty(obj):
+            mesh = gather_mesh(self.settings, obj, timer, self.sections)
+            cached = (fingerprint(mesh.matrix, mesh.faces, mesh.vertices, mesh.uvs, mesh.normals,
+                                  mesh.co, mesh.bones, mesh.weights), mesh)
+            self.meshes[obj.name] = cached
+        return cached
+
+    def flush(self, context):
+        """
+        Rewrites the files whose armatures or meshes changed since they
+        were last written.
+        """
+        settings = self.settings
+        timer = p3m_profile.PhaseTimer("Watch exported {}".format(os.path.basename(settings.filepath)))
+
+        objects = self.candidates()
+        jobs = self.jobs(objects)
+        skeletons = {}
+        meshes = {}
+        rewritten = 0
+
+        for strFilepath, armatures, mesh_objects in jobs:
+            # Batch files of the same armature share its skeleton
+            names = tuple(obj.name for obj in armatures)
+            if names not in skeletons:
+                skeletons[names] = self.gather_skeleton(armatures, timer)
+            skeleton_key, skeleton = skeletons[names]
+
+            gathered = []
+            for obj in mesh_objects:
+                meshes[obj.name] = self.gather_mesh(obj, timer)
+                gathered.append(meshes[obj.name])
+
+            key = (skeleton_key,) + tuple(mesh_key for mesh_key, _ in gathered)
+            if self.written.get(strFilepath) == key:
+                continue
+
+            write_p3m(strFilepath, skeleton, [mesh for _, mesh in gathered], timer)
+            if settings.lod_levels > 0:
+                export_lods(strFilepath, settings.lod_levels, settings.lod_ratio,
+                            settings.vertex_cache_size if settings.optimize_vertex_cache else None, timer)
+            self.written[strFilepath] = key
+            rewritten += 1
+
+        # Forget the objects that were deleted or renamed
+        self.skeletons = skeletons
+        self.meshes = meshes
+        self.sections.prune(meshes)
+
+        self.dirty_objects.clear()
+        self.dirty_data.clear()
+        self.everything_dirty = False
+
+        if rewritten:
+            log.info("Rewrote %d of %d files", rewritten, len(jobs))
+            log.info("%s", timer.report())
+        return rewritten
+
+
+def start_watch(self, context):
+    """
+    Exports with the options of an ExportFile operator, then keeps
+    exporting whenever the scene changes until stop_watch is called.
+    """
+    global watcher
+    stop_watch()
+
+    settings = SimpleNamespace(**{name: getattr(self, name) for name in WATCH_SETTINGS})
+    object_names = [obj.name for obj in context.selected_objects] if self.selected_only else None
+    watcher = ExportWatcher(settings, object_names, self.watch_delay)
+    watcher.start(context)
+    return watcher
+
+
+def stop_watch():
+    global watcher
+    if watcher is not None:
+        watcher.stop()
+        watcher = None
+
+
 class ExportFile(Operator, ExportHelper):
     """Export a P3M file"""
     bl_idname = "export_model.p3m"
@@ -260,18 +868,120 @@ class ExportFile(Operator, ExportHelper):
 
     filepath = bpy.props.StringProperty(subtype='FILE_PATH')
 
+    merge_distance: bpy.props.FloatProperty(
+        name="Bone merge distance",
+        description="Sibling bones whose heads are at most this far apart share a single position bone. 0 only merges exactly matching heads",
+        default=1e-6,
+        min=0.0,
+        precision=6,
+    )
+
+    optimize_vertex_cache: bpy.props.BoolProperty(
+        name="Optimize for vertex cache",
+        description="Reorders triangles and vertices so the game fetches fewer vertices when drawing the model. Slower to export",
+        default=False,
+    )
+
+    vertex_cache_size: bpy.props.IntProperty(
+        name="Vertex cache size",
+        description="Number of vertices the targeted GPU keeps in its post-transform cache",
+        default=p3m_optimize.DEFAULT_CACHE_SIZE,
+        min=4,
+        max=64,
+    )
+
+    lod_levels: bpy.props.IntProperty(
+        name="LOD levels",
+        description="Number of simplified copies written next to the file as <name>_lod1.p3m, <name>_lod2.p3m... UV seams, boundaries and bone influences are kept",
+        default=0,
+        min=0,
+        max=8,
+    )
+
+    lod_ratio: bpy.props.FloatProperty(
+        name="LOD ratio",
+        description="Share of the triangles of the previous level each level aims to keep",
+        default=0.5,
+        min=0.05,
+        max=0.95,
+    )
+
+    batch_mode: bpy.props.BoolProperty(
+        name="One file per mesh",
+        description="Writes every mesh with the armature deforming it to its own file, named after the mesh, in the chosen folder. Meshes whose names give the same file name get a numeric suffix",
+        default=False,
+    )
+
+    selected_only: bpy.props.BoolProperty(
+        name="Selected only",
+        description="Only exports the selected objects",
+        default=False,
+    )
+
+    watch: bpy.props.BoolProperty(
+        name="Watch for changes",
+        description="Keeps exporting after every change to the exported objects, rewriting only the files whose content changed. Stop it from File > Export",
+        default=False,
+    )
+
+    watch_delay: bpy.props.FloatProperty(
+        name="Watch delay",
+        description="Seconds without changes to wait for before exporting again",
+        default=0.5,
+        min=0.05,
+        max=10.0,
+    )
+
+    verbosity: bpy.props.EnumProperty(
+        name="Verbosity",
+        description="How much is reported to the system console, including a per-phase timing summary",
+        items=p3m_profile.VERBOSITY_ITEMS,
+        default='INFO',
+    )
+
     def execute(self, context):
         os.system("cls")
+        p3m_profile.set_verbosity(self.verbosity)
 
         if context.active_object.mode == 'EDIT':
             bpy.ops.object.mode_set(mode='OBJECT')
 
-        export_object(self, context)
+        if self.watch:
+            start_watch(self, context)
+            self.report({'INFO'}, "Watching for changes to export to {}".format(os.path.basename(self.filepath)))
+            return {'FINISHED'}
+
+        if not self.batch_mode:
+            export_object(self, context)
+            return {'FINISHED'}
+
+        count, failures = export_batch(self, context)
+        for strFilepath, error in failures:
+            self.report({'WARNING'}, "Could not export {}: {}".format(os.path.basename(strFilepath), error))
+
+        if failures and len(failures) == count:
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+
+class StopWatch(Operator):
+    """Stop exporting P3M files on every change"""
+    bl_idname = "export_model.p3m_stop_watch"
+    bl_label = "Stop P3M Watch"
+
+    @classmethod
+    def poll(cls, context):
+        return watcher is not None
+
+    def execute(self, context):
+        stop_watch()
         return {'FINISHED'}
 
 
 def create_menu(self, context):
     self.layout.operator(ExportFile.bl_idname, text="Perfect 3D Model (.p3m)")
+    if watcher is not None:
+        self.layout.operator(StopWatch.bl_idname, text="Stop Perfect 3D Model (.p3m) watch")
 
 
 def register():
@@ -279,6 +989,7 @@ def register():
     Handles the registration of the Blender Addon.
     """
     bpy.utils.register_class(ExportFile)
+    bpy.utils.register_class(StopWatch)
     bpy.types.TOPBAR_MT_file_export.append(create_menu)
 
 
@@ -286,7 +997,9 @@ def unregister():
     """
     Handles the unregistering of this Blender Addon.
     """
+    stop_watch()
     bpy.utils.unregister_class(ExportFile)
+    bpy.utils.unregister_class(StopWatch)
     bpy.types.TOPBAR_MT_file_export.remove(create_menu)
 
 
@@ -22,164 +22,296 @@ bl_info = {
     "category": "Import-Export"
 }
 
+import concurrent.futures
 import os
-import struct
 import bmesh
 import bpy
 import mathutils
-from bpy.props import (BoolProperty, CollectionProperty, StringProperty)
+import numpy as np
+from bpy.props import (BoolProperty, CollectionProperty, EnumProperty, IntProperty, StringProperty)
 from bpy.types import Operator, OperatorFileListElement
 from bpy_extras.io_utils import ImportHelper
 
-class ONE_TRIANGLE():
-    def __init__(self, a, b, c):
-        self.m_usA = a
-        self.m_usB = b
-        self.m_usC = c
-    
-    def __repr__(self):
-        return "ONE_TRIANGLE({}, {}, {})".format(self.m_usA, self.m_usB, m_usC)
+import p3m_cache
+import p3m_codec
+import p3m_profile
+import p3m_skeleton
 
-    def __str__(self):
-        return 'ONE_TRIANGLE: \n Triangle : A: {} B: {} C: {}'.format(self.m_usA, self.m_usB, self.m_usC)
-        
-    @property
-    def a(self):
-        return self.m_usA
-    
-    @property
-    def b(self):
-        return self.m_usB
-    
-    @property
-    def c(self):
-        return self.m_usC
-
-class SKINVERTEX():
-    def __init__(self, fVectorPosX = 0.0, fVectorPosY = 0.0, fVectorPosZ = 0.0, fWeight = 0.0, ucIndex = 0, fVectorNorX = 0.0, fVectorNorY = 0.0, fVectorNorZ = 0.0, fTu = 0.0, fTv = 0.0):
-        self.m_fVectorPosX = fVectorPosX
-        self.m_fVectorPosY = fVectorPosY
-        self.m_fVectorPosZ = fVectorPosZ
-        self.m_fWeight = fWeight
-        self.m_ucIndex = ucIndex
-        self.m_fVectorNorX = fVectorNorX
-        self.m_fVectorNorY = fVectorNorY
-        self.m_fVectorNorZ = fVectorNorZ
-        self.m_fTu = fTu
-        self.m_fTv = fTv
-    
-    def __getitem__(self, index):
-        if index == 0:
-            return self.m_ucIndex
-        else:
-            return self.m_fWeight
-    @property
-    def fTu(self):
-        return self.m_fTu
-    
-    @property
-    def ucIndex(self):
-        return self.m_ucIndex
-        
-    @property
-    def fWeight(self):
-        return self.m_fWeight
-    
-    @property
-    def fTv(self):
-        return self.m_fTv
-    
-    def __repr__(self):
-        return "SKINVERTEX({}, {}, {}, {}, {}, {}, {}, {}, {}, {})".format(self.m_fVectorPosX, self.m_fVectorPosY, self.m_fVectorPosZ, self.m_fWeight, self.m_ucIndex, self.m_fVectorNorX, self.m_fVectorNorY, self.m_fVectorNorZ, self.m_fTu, self.m_fTv)
-
-    def __str__(self):
-        return 'SKINVERTEX: \n VectorPos (X, Y, Z): {} {} {}\n Weight: {}\n Index: {}\n VectorNor (X, Y, Z): {} {} {}\n fTu: {}\n fTv: {}'.format(self.m_fVectorPosX, self.m_fVectorPosY, self.m_fVectorPosZ, self.m_fWeight, self.m_ucIndex, self.m_fVectorNorX, self.m_fVectorNorY, self.m_fVectorNorZ, self.m_fTu, self.m_fTv)
-
-class AngleBoneFromFile():
-    def __init__(self, fVectorX = 0.0, fVectorY = 0.0, fVectorZ = 0.0, fScale = 0.0, aucChildIndex = None):
-        self.m_fVectorX = fVectorX
-        self.m_fVectorY = fVectorY
-        self.m_fVectorZ = fVectorZ
-        self.m_fScale = fScale
-        self.m_aucChildIndex = aucChildIndex
-        
-    def __repr__(self):
-        return "AngleBoneFromFile({}, {}, {}, {}. {})".format(self.m_fVectorX, self.m_fVectorY, self.m_fVectorZ, self.m_fScale, self.m_aucChildIndex)
+log = p3m_profile.get_logger("importer")
 
-    def __str__(self):
-        return 'AngleBoneFromFile: \n Vector (X, Y, Z, Scale): {} {} {} {}\n ChildIndex : {}'.format(self.m_fVectorX, self.m_fVectorY, self.m_fVectorZ, self.m_fScale, self.m_aucChildIndex)
-        
-    @property
-    def aucChildIndex(self):
-        return self.m_aucChildIndex
-
-class PositionBone():
-    def __init__(self, fVectorX = 0.0, fVectorY = 0.0, fVectorZ = 0.0, aucChildIndex = None):
-        self.m_fVectorX = fVectorX
-        self.m_fVectorY = fVectorY
-        self.m_fVectorZ = fVectorZ
-        self.m_aucChildIndex = aucChildIndex
-        
-    def __repr__(self):
-        return "PositionBone({}, {}, {}, {})".format(self.m_fVectorX, self.m_fVectorY, self.m_fVectorZ, self.m_aucChildIndex)
+# DirectX (Y up, left handed) to Blender (Z up, right handed)
+correct_orientation = mathutils.Matrix([[-1.0, 0.0, 0.0, 0.0],
+                                        [0.0, 0.0, 1.0, 0.0],
+                                        [0.0, 1.0, 0.0, 0.0],
+                                        [0.0, 0.0, 0.0, 1.0]])
+orientation = np.array(correct_orientation.to_3x3(), dtype=np.float64)
 
-    def __str__(self):
-        return 'PositionBone: \n Vector (X, Y, Z): {} {} {}\n ChildIndex : {}'.format(self.m_fVectorX, self.m_fVectorY, self.m_fVectorZ, self.m_aucChildIndex)
-        
-    @property
-    def aucChildIndex(self):
-        return self.m_aucChildIndex    
-        
-    @property
-    def fVectorX(self):
-        return self.m_fVectorX    
-        
-    @property
-    def fVectorY(self):
-        return self.m_fVectorY    
-        
-    @property
-    def fVectorZ(self):
-        return self.m_fVectorZ    
+# Custom property holding p3m_codec.skeleton_fingerprint on imported armatures
+SKELETON_FINGERPRINT = "p3m_skeleton"
+
+# Custom property holding the source file of a bounding box proxy
+PROXY_FILEPATH = "p3m_filepath"
+
+IMPORT_MODE_ITEMS = [
+    ('FULL', "Full", "Armature and skinned mesh"),
+    ('SKELETON', "Armature only", "Only the bones, the mesh sections are not decoded"),
+    ('MESH', "Mesh only", "The mesh without armature or vertex groups"),
+    ('PROXY', "Bounding box", "An empty spanning the model, read from the vertex positions alone"),
+]
+
+
+def build_mesh(mesh, vecPosition, vecIndex, vecUV):
+    """
+    Fills an empty mesh in bulk with foreach_set.
+
+    Raises P3MError before touching the mesh if a triangle uses a vertex
+    that does not exist, which foreach_set would not catch.
+    """
+    dwNumVertex = len(vecPosition)
+    dwNumFace = len(vecIndex)
+    p3m_codec.check_triangles(vecIndex, dwNumVertex)
+
+    mesh.vertices.add(dwNumVertex)
+    mesh.vertices.foreach_set("co", vecPosition.astype(np.float32).ravel())
+
+    mesh.loops.add(dwNumFace * 3)
+    mesh.loops.foreach_set("vertex_index", vecIndex.ravel())
+
+    mesh.polygons.add(dwNumFace)
+    mesh.polygons.foreach_set("loop_start", np.arange(0, dwNumFace * 3, 3, dtype=np.int32))
+    if not mesh.polygons.bl_rna.properties["loop_total"].is_readonly:
+        mesh.polygons.foreach_set("loop_total", np.full(dwNumFace, 3, dtype=np.int32))
+    mesh.polygons.foreach_set("use_smooth", np.ones(dwNumFace, dtype=bool))
+
+    uv_layer = mesh.uv_layers.new()
+    uv_layer.data.foreach_set("uv", vecUV[vecIndex.ravel()].astype(np.float32).ravel())
+
+    mesh.update(calc_edges=True)
+
+    # Drops degenerate and duplicate triangles, like bm.faces.new refusing them
+    if mesh.validate(clean_customdata=False):
+        log.warning("Removed invalid geometry from %s", mesh.name)
+
+
+def build_mesh_bmesh(mesh, vecPosition, vecNormal, vecIndex, vecUV):
+    """
+    Builds the mesh one element at a time through bmesh.
+    """
+    bm = bmesh.new()
+
+    for position, normal in zip(vecPosition.tolist(), vecNormal.tolist()):
+        vertex = bm.verts.new(position)
+        vertex.normal = mathutils.Vector(normal)
+
+    bm.verts.ensure_lookup_table()
+    bm.verts.index_update()
     
+    uv_layer = bm.loops.layers.uv.verify()
+    uvs = vecUV.tolist()
+
+    skipped = 0
+    for a, b, c in vecIndex.tolist():
+        try:
+            face = bm.faces.new((bm.verts[a], bm.verts[b], bm.verts[c]))
+        except ValueError:
+            # degenerate triangle or face that already exists
+            skipped += 1
+            continue
+
+        face.smooth = True
+        for vert, loop in zip(face.verts, face.loops):
+            loop[uv_layer].uv = uvs[vert.index]
+
+    if skipped:
+        log.warning("Skipped %d invalid triangles", skipped)
+
+    bm.to_mesh(mesh)
+    bm.free()
+
 
-def import_p3m(context, strFilepath, hide_unused_bones):
-    strModelName = bpy.path.basename(strFilepath)    
+def set_custom_normals(mesh, vecNormal):
+    if hasattr(mesh, "use_auto_smooth"):
+        # Blender < 4.1 only uses custom normals with auto smooth enabled
+        mesh.use_auto_smooth = True
+    mesh.normals_split_custom_set_from_vertices(vecNormal.tolist())
+
+
+def weight_buckets(vecBone, vecWeight, skinned):
+    """
+    Groups the skinned vertices by (bone, weight) so every group gets a
+    single vertex_groups.add call per distinct weight.
+    """
+    indices = np.flatnonzero(skinned)
+    bones = vecBone[indices]
+    weights = vecWeight[indices]
+
+    order = np.lexsort((weights, bones))
+    indices, bones, weights = indices[order], bones[order], weights[order]
+
+    changed = (bones[1:] != bones[:-1]) | (weights[1:] != weights[:-1])
+    starts = np.flatnonzero(np.concatenate(([True], changed))) if len(indices) else np.zeros(0, dtype=np.intp)
+    ends = np.append(starts[1:], len(indices))
+
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        yield int(bones[start]), float(weights[start]), indices[start:end].tolist()
+
+
+# DecodedP3M arrays kept in the decode cache, so a hit skips the transform
+CACHED_ARRAYS = ("vecIndex", "vecPosition", "vecNormal", "vecUV", "vecBone", "skinned")
+
+
+class DecodedP3M():
+    """
+    A P3M file decoded and resolved into the arrays the build step needs,
+    already in Blender's orientation.
+    """
+    def __init__(self, strFilepath, model, skeleton, timer, mode='FULL'):
+        self.filepath = strFilepath
+        self.model = model
+        self.skeleton = skeleton
+        self.timer = timer
+        self.mode = mode
+        self.bbox = None
+
+        self.vecIndex = None
+        self.vecPosition = None
+        self.vecNormal = None
+        self.vecUV = None
+        self.vecBone = None
+        self.skinned = None
+
+
+def decode_partial(strFilepath, timer, mode):
+    """
+    Reads only what the SKELETON and PROXY modes need. The mesh sections
+    are never decoded: the bone sections come first in the file and the
+    proxy only goes through the vertex positions with a strided view.
+    """
+    with timer.phase("read", unit="bytes") as phase:
+        reader = p3m_codec.P3MReader(strFilepath)
+        phase.count = reader.layout.mesh_count if mode == 'SKELETON' else reader.layout.size
+
+    # The phases are siblings so the report does not count any time twice,
+    # the reader stays open for the strided view of the proxy
+    with reader:
+        with timer.phase("decode", unit="records") as phase:
+            empty = p3m_codec.P3MModel(reader.version, reader.position_bones.copy(), reader.angle_bones.copy(),
+                                       np.zeros(0, p3m_codec.TRIANGLE_DTYPE), np.zeros(0, p3m_codec.SKINVERTEX_DTYPE),
+                                       reader.texture)
+            phase.count = len(empty.position_bones) + len(empty.angle_bones)
+            if mode == 'PROXY':
+                mapped = p3m_codec.P3MModel(reader.version, empty.position_bones, empty.angle_bones,
+                                            reader.triangles, reader.vertices)
+                phase.count += len(mapped.vertices)
+
+        with timer.phase("skeleton", len(empty.angle_bones), "bones"):
+            skeleton = p3m_skeleton.resolve_skeleton(empty.position_bones, empty.angle_bones)
+
+        decoded = DecodedP3M(strFilepath, empty, skeleton, timer, mode)
+
+        if mode == 'PROXY':
+            with timer.phase("transform", len(mapped.vertices), "vertices"):
+                bbox = p3m_skeleton.bounding_box(mapped, skeleton)
+                if bbox is not None:
+                    # The orientation only swaps and flips axes, the box stays axis aligned
+                    corners = np.array(bbox) @ orientation.T
+                    decoded.bbox = corners.min(axis=0), corners.max(axis=0)
+            del mapped
+
+    return decoded
+
+
+def decode_file(strFilepath, cache=None, mode='FULL'):
+    """
+    Reads, decodes and resolves a P3M file without touching bpy, so it can
+    run on a worker thread while the main thread builds other files.
+
+    With a p3m_cache.DecodeCache, a file whose content was decoded before is
+    loaded with its skeleton resolved and its vertices transformed. The
+    cache is only used by the modes that decode the whole file.
+
+    Raises OSError or P3MError, including for bone, vertex and triangle
+    indices out of range, so nothing left for build_p3m can fail on the
+    file's content.
+    """
+    strModelName = os.path.splitext(os.path.basename(strFilepath))[0]
+    timer = p3m_profile.PhaseTimer("Imported {}".format(strModelName))
     
-    print("\n\nImporting P3M file {}\n\n".format(strModelName))
+    if mode in ('SKELETON', 'PROXY'):
+        return decode_partial(strFilepath, timer, mode)
     
-    strModelName = os.path.splitext(strModelName)[0]
+    cached = None
+    if cache is not None:
+        with timer.phase("cache") as phase:
+            key, cached = cache.lookup(strFilepath)
+            phase.count = 1 if cached else 0
+            phase.unit = "hits"
     
-    iFile = open(strFilepath, 'rb')
+    if cached:
+        model, skeleton, arrays = cached
+        decoded = DecodedP3M(strFilepath, model, skeleton, timer, mode)
+        for name in CACHED_ARRAYS:
+            setattr(decoded, name, arrays[name])
+        return decoded
     
-    buffStrP3MVer = iFile.read(26)
-    strP3MVer, = struct.unpack('<26s', buffStrP3MVer) # read P3M Version
+    with timer.phase("read", unit="bytes") as phase:
+        reader = p3m_codec.P3MReader(strFilepath)
+        phase.count = reader.layout.size
     
-    iFile.read(1); # skip padding 
+    with reader, timer.phase("decode", unit="records") as phase:
+        model = reader.to_model()
+        phase.count = len(model.position_bones) + len(model.angle_bones) + len(model.triangles) + len(model.vertices)
     
-    print("{}\n".format(strP3MVer))
+    with timer.phase("skeleton", len(model.angle_bones), "bones"):
+        skeleton = p3m_skeleton.resolve_skeleton(model.position_bones, model.angle_bones)
     
-    buff = iFile.read(2)
-    dwNumPositionBone, dwNumAngleBone = struct.unpack('<2B', buff)
-    pPositionBone = []
-    print(" NumPositionBone: {0}\n NumAngleBone: {1}".format(dwNumPositionBone, dwNumAngleBone))
+    decoded = DecodedP3M(strFilepath, model, skeleton, timer, mode)
     
-    print("\n\nReading pPositionBone:")
-    for i in range(dwNumPositionBone):
-        buff = iFile.read(12) # 3 Float Size = 12
-        fVectorX, fVectorY, fVectorZ = struct.unpack('<3f',buff) 
+    with timer.phase("transform", len(model.vertices), "vertices"):
+        p3m_codec.check_triangles(model.triangles['index'], len(model.vertices))
+        decoded.vecIndex = model.triangles['index'].astype(np.int32)
         
-        aucChildIndex = []  
-        for j in range(10): # KSafeArray<unsigned char,10> acChildIndex
-            ChildIndex, = struct.unpack('<B',iFile.read(1))
-            if ChildIndex != 255:
-                aucChildIndex.insert(j, ChildIndex)   
+        # Skinned vertices are stored relative to the head of their bone
+        vecBone = p3m_skeleton.vertex_bones(model)
+        skinned = vecBone >= 0
+        vecPosition = p3m_skeleton.absolute_positions(model, skeleton, vecBone)
+        
+        #DirectX to OpenGL UV Mapping
+        vecUV = model.vertices['uv'].astype(np.float64)
+        vecUV[:, 1] = 1 - vecUV[:, 1]
         
-        pPositionBone_ = PositionBone(fVectorX, fVectorY, fVectorZ, aucChildIndex)
-        print( "Index {}:\n{}".format(i, str(pPositionBone_)))
-        pPositionBone.insert(i, pPositionBone_)
-        iFile.read(2) #Struct Padding
+        # The mesh data is reoriented here rather than with mesh.transform so
+        # the custom normals match the vertices
+        decoded.vecPosition = vecPosition @ orientation.T
+        decoded.vecNormal = model.vertices['normal'].astype(np.float64) @ orientation.T
+        decoded.vecUV = vecUV
+        decoded.vecBone = vecBone
+        decoded.skinned = skinned
     
+    # Only stored once the whole file is known to be valid
+    if cache is not None and key is not None:
+        with timer.phase("cache"):
+            try:
+                cache.store(key, model, skeleton, {name: getattr(decoded, name) for name in CACHED_ARRAYS},
+                            strFilepath)
+            except OSError as error:
+                log.warning("Could not cache %s: %s", strModelName, error)
+    
+    return decoded
+
+
+def find_shared_armature(context, fingerprint):
+    """
+    Returns an armature object of the current scene imported from a file
+    with byte-identical bone tables, or None.
+    """
+    for obj in context.scene.objects:
+        if obj.type == 'ARMATURE' and obj.data.get(SKELETON_FINGERPRINT) == fingerprint:
+            return obj
+    return None
+
+
+def build_armature(context, strModelName, skeleton, hidden_bones):
     armature = bpy.data.armatures.new('Armature') 
     armature_object = bpy.data.objects.new("%s_armature" % strModelName, armature)
 
@@ -188,195 +320,189 @@ def import_p3m(context, strFilepath, hide_unused_bones):
     
     bpy.ops.object.mode_set(mode='EDIT')
     
-    pAngleBone = []
-    print("\n\nReading pAngleBone:")   
-    for i in range(dwNumAngleBone):
-        buff = iFile.read(16) # 4 Float Size = 16
-        fVectorX, fVectorY, fVectorZ, fScale = struct.unpack('<4f',buff) 
-        
-        joint = armature.edit_bones.new("bone_%d" % i)
-        for j in range(dwNumPositionBone):
-            for x in pPositionBone[j].aucChildIndex:
-                if i == x:
-                    vectorPos = (pPositionBone[j].fVectorX, pPositionBone[j].fVectorY, pPositionBone[j].fVectorZ)
-                    print(" X: {}\n Y: {}\n Z: {}".format(pPositionBone[j].fVectorX, pPositionBone[j].fVectorY, pPositionBone[j].fVectorZ))
-                    joint.head = mathutils.Vector(vectorPos)
-                    joint.tail = mathutils.Vector(vectorPos)
-        
-        aucChildIndex = []
-        for j in range(10): # KSafeArray<unsigned char,10> acChildIndex
-            ChildIndex, = struct.unpack('<B',iFile.read(1))
-            if ChildIndex != 255:
-                aucChildIndex.insert(j, ChildIndex)
-        
-        pAngleBone_ = AngleBoneFromFile(fVectorX, fVectorY, fVectorZ, fScale, aucChildIndex)
-        print( "Index {}:\n{}".format(i, str(pAngleBone_)))
-        pAngleBone.insert(i, pAngleBone_)
-        iFile.read(2) #Struct Padding
+    # Bones are created in file order so bone_%d, the edit bone index and
+    # the vertex group index all match the angle bone index
+    edit_bones = armature.edit_bones
+    for i, (head, tail) in enumerate(zip(skeleton.heads.tolist(), skeleton.tails.tolist())):
+        joint = edit_bones.new("bone_%d" % i)
+        joint.head = head
+        joint.tail = tail
     
-    for i in range(dwNumAngleBone):
-        chIndex = []
-        for posTree in pAngleBone[i].aucChildIndex:
-            for angTree in pPositionBone[posTree].aucChildIndex:
-                chIndex.append(angTree)
-                print("pos : {} ang {}".format(posTree, angTree))
-        print(len(chIndex))
-        if len(chIndex) != 1:
-            current = armature.edit_bones[i]
-            parent = current.parent
-
-            if parent != None:
-                v = (parent.tail - parent.head).normalized() * 0.05
-            else:
-                v = mathutils.Vector((0, 0.05, 0))
+    for i in skeleton.tree.order:
+        parent = skeleton.tree.parents[i]
+        if parent >= 0:
+            edit_bones[i].parent = edit_bones[parent]
+    
+    for x in hidden_bones:
+        edit_bones[x].hide = True
+    
+    # corrects orientation
+    armature.transform(correct_orientation)
+    
+    bpy.ops.object.mode_set(mode='OBJECT')
 
-            current.tail = current.head + v
-        print(chIndex)
-        for idx in chIndex:
-            current = armature.edit_bones[i]
-            child = armature.edit_bones[idx]
+    # Bone.hide is the pose mode visibility, no need to go through the operators
+    for x in hidden_bones:
+        armature.bones[x].hide = True
 
-            child.parent = current
-            child.head = child.parent.head + child.head
+    return armature_object
 
-            if len(chIndex) == 1:
-                current.tail = child.head
-        
-    buff = iFile.read(4)
-    dwNumVertex, dwNumFace = struct.unpack('<2H', buff)
-    print(" NumVertex: {0}\n NumFace: {1}".format(dwNumVertex, dwNumFace))
+
+def build_proxy(context, strModelName, decoded):
+    """
+    Creates an empty spanning the bounding box of a file decoded in PROXY
+    mode, tagged with the file path so the full model can be imported later.
+    """
+    proxy_object = bpy.data.objects.new("%s_proxy" % strModelName, None)
+    proxy_object.empty_display_type = 'CUBE'
+    proxy_object[PROXY_FILEPATH] = decoded.filepath
     
-    iFile.read(260) #skips reading texture
-        
-    vecIndex = []
-    print("\n\nReading Triangle Vertices:")   
-    for i in range(dwNumFace):
-        triangleBuff = iFile.read(6)
-        a, b, c = struct.unpack('<3H', triangleBuff)
-        triangle = ONE_TRIANGLE(a, b, c)
-        print( "Index {}:\n{}".format(i, str(triangle)))
-        vecIndex.append(triangle)
-        
-    bm = bmesh.new()
-    mesh = bpy.data.meshes.new("%s_mesh" % strModelName)   
-     
-    vecVertex = []
-    print("\n\nReading Skin Vertices:")
+    if decoded.bbox is not None:
+        low, high = decoded.bbox
+        # A flat model still gets a box that can be seen and selected
+        proxy_object.location = ((low + high) / 2).tolist()
+        proxy_object.scale = np.maximum((high - low) / 2, 1e-4).tolist()
     
-    for i in range(dwNumVertex):
-        buff = iFile.read(16) # 4 Float Size = 16
-        fVectorPosX, fVectorPosY, fVectorPosZ, fWeight = struct.unpack('<4f',buff)
-        
-        aucIndex = []
-        buff = iFile.read(1)
-        ucIndex, = struct.unpack('<B', buff)
-        if ucIndex != 255:
-            ucIndex = ucIndex - dwNumPositionBone
-            
-            fVectorPosX += armature.edit_bones[ucIndex].head[0]
-            fVectorPosY += armature.edit_bones[ucIndex].head[1]
-            fVectorPosZ += armature.edit_bones[ucIndex].head[2]
+    bpy.context.collection.objects.link(proxy_object)
+    context.view_layer.objects.active = proxy_object
+    return proxy_object
+
+
+def build_p3m(context, decoded, hide_unused_bones, use_fast_mesh=True, share_armatures=True):
+    """
+    Creates the armature and mesh objects of a decoded file. Must run on
+    the main thread.
+
+    With share_armatures, a file whose bone tables match an armature that
+    is already in the scene is bound to that armature instead of a new one.
+    Files decoded in SKELETON mode only get the armature, in MESH mode only
+    the mesh, without vertex groups, and in PROXY mode a bounding box empty.
+    """
+    strModelName = os.path.splitext(bpy.path.basename(decoded.filepath))[0]
+    model = decoded.model
+    skeleton = decoded.skeleton
+    timer = decoded.timer
+    
+    log.debug("%s", model.version)
+    
+    dwNumAngleBone = len(model.angle_bones)
+    dwNumVertex = len(model.vertices)
+    dwNumFace = len(model.triangles)
+    log.info(" NumPositionBone: %d NumAngleBone: %d NumVertex: %d NumFace: %d", len(model.position_bones), dwNumAngleBone, dwNumVertex, dwNumFace)
+    
+    if decoded.mode == 'PROXY':
+        with timer.phase("proxy", 1, "objects"):
+            build_proxy(context, strModelName, decoded)
+        log.info("%s", timer.report())
+        return
+    
+    vecBone = decoded.vecBone
+    skinned = decoded.skinned
+    
+    if decoded.mode == 'FULL':
+        # Bones that influence no vertex, directly or through any of their descendants
+        influence = np.bincount(vecBone[skinned], minlength=dwNumAngleBone)
+        unused = skeleton.tree.subtree_totals(influence) == 0
+    else:
+        # Without the mesh there is nothing to tell the unused bones apart
+        hide_unused_bones = False
+    
+    armature_object = None
+    if decoded.mode != 'MESH':
+        with timer.phase("skeleton", 0, "bones"):
+            fingerprint = p3m_codec.skeleton_fingerprint(model)
+            armature_object = find_shared_armature(context, fingerprint) if share_armatures else None
             
-        iFile.read(3) #padding
-                    
-        buff = iFile.read(20) # 5 Float Size = 20
-        fVectorNorX, fVectorNorY, fVectorNorZ, fTu, fTv = struct.unpack('<5f', buff)
-        
-        #DirectX to OpenGL UV Mapping
-        fTv = 1 - fTv
+            if armature_object is None:
+                hidden_bones = np.flatnonzero(unused).tolist() if hide_unused_bones else []
+                if hidden_bones:
+                    log.info("Hiding %d unused bones", len(hidden_bones))
+                
+                armature_object = build_armature(context, strModelName, skeleton, hidden_bones)
+                armature_object.data[SKELETON_FINGERPRINT] = fingerprint
+            else:
+                log.info("Sharing armature %s", armature_object.name)
+                
+                # Only reveal bones on a shared armature, the meshes already bound
+                # to it may use the ones this file does not
+                if hide_unused_bones:
+                    for x in np.flatnonzero(~unused).tolist():
+                        armature_object.data.bones[x].hide = False
+    
+    if decoded.mode == 'SKELETON':
+        context.view_layer.objects.active = armature_object
+        log.info("%s", timer.report())
+        return
+    
+    with timer.phase("mesh", dwNumFace, "faces"):
+        mesh = bpy.data.meshes.new("%s_mesh" % strModelName)   
         
-        vecVertex_ = SKINVERTEX(fVectorPosX, fVectorPosY, fVectorPosZ, fWeight, ucIndex, fVectorNorX, fVectorNorY, fVectorNorZ, fTu, fTv)
+        if use_fast_mesh:
+            build_mesh(mesh, decoded.vecPosition, decoded.vecIndex, decoded.vecUV)
+        else:
+            build_mesh_bmesh(mesh, decoded.vecPosition, decoded.vecNormal, decoded.vecIndex, decoded.vecUV)
         
+        set_custom_normals(mesh, decoded.vecNormal)
         
+        mesh_object = bpy.data.objects.new("%s_mesh" % strModelName, mesh)
 
-        vertex = bm.verts.new((fVectorPosX, fVectorPosY, fVectorPosZ))
-
-        vertex.normal = mathutils.Vector((fVectorNorX, fVectorNorY, fVectorNorZ))
-        print(vertex.normal)
-        print( "Index {}:\n{}".format(i, str(vecVertex_)))
-        vecVertex.insert(i, vecVertex_)
+    if armature_object is not None:
+        with timer.phase("skinning", int(np.count_nonzero(skinned)), "vertices"):
+            for x in range(dwNumAngleBone):
+                mesh_object.vertex_groups.new(name="bone_%d" % x)
 
-    bm.verts.ensure_lookup_table()
-    bm.verts.index_update()
-    
-    uv_layer = bm.loops.layers.uv.verify()
+            vertex_groups = mesh_object.vertex_groups
+            for ucIndex, fWeight, indices in weight_buckets(vecBone, model.vertices['weight'], skinned):
+                log.debug("bone_%d: %d vertices with weight %f", ucIndex, len(indices), fWeight)
+                vertex_groups[ucIndex].add(indices, fWeight, "REPLACE")
 
-    for vecInd in vecIndex:
-        a = bm.verts[vecInd.a]
-        b = bm.verts[vecInd.b]
-        c = bm.verts[vecInd.c]
+        mesh_object.parent = armature_object
+        modifier = mesh_object.modifiers.new(type='ARMATURE', name="Armature")
+        modifier.object = armature_object
 
-        try:
-            face = bm.faces.new((a, b, c))
-        except:
-            pass
-
-        for vert, loop in zip(face.verts, face.loops):
-            tu = vecVertex[vert.index].fTu
-            tv = vecVertex[vert.index].fTv
-
-            loop[uv_layer].uv = (tu, tv)
-
-    bm.to_mesh(mesh)
-    bm.free()
+    bpy.context.collection.objects.link(mesh_object)
+    context.view_layer.objects.active = mesh_object
+    #finish 7-7-2020
     
-    mesh_object = bpy.data.objects.new("%s_mesh" % strModelName, mesh)
-
-    print("\n\nRendering Vertices")
+    log.info("%s", timer.report())
 
-    for x in range(dwNumAngleBone):
-        mesh_object.vertex_groups.new(name="bone_%d" % x)
 
-    for i in range(len(vecVertex)):
-        if vecVertex[i].ucIndex != 255:
-            ucIndex = vecVertex[i].ucIndex
-            fWeight = vecVertex[i].fWeight
-            mesh_object.vertex_groups[ucIndex].add([i], fWeight, "REPLACE")
+def import_p3m(context, strFilepath, hide_unused_bones, use_fast_mesh=True, cache=None, share_armatures=True,
+               import_mode='FULL'):
+    log.info("Importing P3M file %s", bpy.path.basename(strFilepath))
+    build_p3m(context, decode_file(strFilepath, cache, import_mode), hide_unused_bones, use_fast_mesh, share_armatures)
 
-    if hide_unused_bones:
-        print("Hiding unused bones...")
 
-        for bone in armature.edit_bones:
-            if not bone.children:
-                for b in [bone, *bone.parent_recursive]:
-                    bone_group = int(b.name.split('_')[-1])
+def import_p3m_files(context, strFilepaths, hide_unused_bones, use_fast_mesh=True, cache=None, share_armatures=True,
+                     import_mode='FULL'):
+    """
+    Imports several files, decoding them on a thread pool while the main
+    thread builds the objects of whichever file is ready first.
 
-                    # if all the bone's children are hidden and there are no vertices influenced by the bone
-                    if not False in [c.hide for c in b.children] and not any([v for v in mesh.vertices if bone_group in [g.group for g in v.groups]]):
-                        b.hide = True
-                    else:
-                        break
+    A file that cannot be read or holds out-of-range indices is reported
+    and skipped, the others are still imported. Returns the list of
+    (filepath, error) of the files that failed.
+    """
+    failures = []
+    workers = min(len(strFilepaths), os.cpu_count() or 1)
 
-        for x in range(len(armature.edit_bones)):
-            bone = armature.edit_bones[x]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        futures = {pool.submit(decode_file, strFilepath, cache, import_mode): strFilepath for strFilepath in strFilepaths}
 
-            if bone.hide:
-                bone.select = True
+        for future in concurrent.futures.as_completed(futures):
+            strFilepath = futures[future]
+            try:
+                decoded = future.result()
+            except (OSError, p3m_codec.P3MError) as error:
+                log.error("Could not read %s: %s", strFilepath, error)
+                failures.append((strFilepath, error))
+                continue
 
-                bpy.ops.object.mode_set(mode='POSE')
-                bpy.ops.pose.hide()
-                bpy.ops.object.mode_set(mode='EDIT')
-
-    # corrects orientation
-    correct_orientation = mathutils.Matrix([[-1.0, 0.0, 0.0, 0.0],
-                                            [0.0, 0.0, 1.0, 0.0],
-                                            [0.0, 1.0, 0.0, 0.0],
-                                            [0.0, 0.0, 0.0, 1.0]])
-    
-    armature.transform(correct_orientation)
-    mesh.transform(correct_orientation)
+            log.info("Importing P3M file %s", bpy.path.basename(strFilepath))
+            build_p3m(context, decoded, hide_unused_bones, use_fast_mesh, share_armatures)
 
-    bpy.ops.object.mode_set(mode='OBJECT')
-    mesh_object.parent = armature_object
-    modifier = mesh_object.modifiers.new(type='ARMATURE', name="Armature")
-    modifier.object = armature_object
+    return failures
 
-    bpy.context.collection.objects.link(mesh_object)
-    context.view_layer.objects.active = mesh_object
-    #finish 7-7-2020
-    
-    
-    
 
 class ImportFile(Operator, ImportHelper):
     """Import a P3M file"""
@@ -396,18 +522,67 @@ class ImportFile(Operator, ImportHelper):
         type=OperatorFileListElement,
     )
 
+    import_mode: EnumProperty(
+        name="Import",
+        description="What to build from each file. The partial modes only read the sections they need",
+        items=IMPORT_MODE_ITEMS,
+        default='FULL',
+    )
+
     hide_unused_bones: BoolProperty(
         name="Hide unused bones",
         description="Hides all the bones that do not influence the mesh. They will still be accessible through the object hierarchy panel and can be selected with the Select Box Tool in the pose mode",
         default=False,
     )
 
+    use_fast_mesh: BoolProperty(
+        name="Fast mesh build",
+        description="Builds the mesh in bulk from the decoded arrays. Disable to fall back to building it face by face with bmesh",
+        default=True,
+    )
+
+    share_armatures: BoolProperty(
+        name="Share armatures",
+        description="Binds files whose bone tables are identical to an armature already in the scene, such as the parts of one character, instead of creating a new one",
+        default=True,
+    )
+
+    use_cache: BoolProperty(
+        name="Cache decoded files",
+        description="Keeps decoded models on disk, keyed by file content, so importing the same file again skips decoding. Files under 128 KB decode faster than they load and are not cached",
+        default=True,
+    )
+
+    cache_size: IntProperty(
+        name="Cache size (MB)",
+        description="Least recently used cache entries are removed past this size",
+        default=p3m_cache.DEFAULT_MAX_BYTES // (1024 * 1024),
+        min=1,
+    )
+
+    verbosity: EnumProperty(
+        name="Verbosity",
+        description="How much is reported to the system console, including a per-phase timing summary",
+        items=p3m_profile.VERBOSITY_ITEMS,
+        default='INFO',
+    )
+
     directory = StringProperty(subtype='DIR_PATH')
 
     def execute(self, context):
-        for file in self.files:
-            strFilepath = os.path.join(self.directory, file.name)
-            import_p3m(context, strFilepath, self.hide_unused_bones)
+        p3m_profile.set_verbosity(self.verbosity)
+
+        strFilepaths = [os.path.join(self.directory, file.name) for file in self.files]
+
+        cache = p3m_cache.DecodeCache(max_bytes=self.cache_size * 1024 * 1024) if self.use_cache else None
+
+        failures = import_p3m_files(context, strFilepaths, self.hide_unused_bones, self.use_fast_mesh, cache,
+                                    self.share_armatures, self.import_mode)
+        for strFilepath, error in failures:
+            self.report({'WARNING'}, "Could not import {}: {}".format(os.path.basename(strFilepath), error))
+
+        if len(failures) == len(strFilepaths):
+            return {'CANCELLED'}
 
         return {'FINISHED'}
 
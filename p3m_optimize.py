@@ -0,0 +1,179 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Index buffer optimization for the post-transform vertex cache.
+
+The game draws P3M meshes straight from their triangle and vertex order.
+Triangles are reordered with Tipsy (Sander, Nehab and Barczak, "Fast
+Triangle Reordering for Vertex Locality and Reduced Overdraw", 2007) and
+vertices are then renumbered by first use so they are fetched in order.
+
+Orders are measured against a FIFO cache:
+ACMR is the average number of cache misses per triangle (0.5 at best for
+large regular meshes, 3 at worst) and ATVR the number of misses per vertex
+(1 at best).
+"""
+
+from collections import deque
+
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 16
+
+
+class CacheStats():
+    def __init__(self, misses, num_faces, num_vertices):
+        self.misses = misses
+        self.acmr = misses / num_faces if num_faces else 0.0
+        self.atvr = misses / num_vertices if num_vertices else 0.0
+
+    def __repr__(self):
+        return "CacheStats(ACMR {:.3f}, ATVR {:.3f})".format(self.acmr, self.atvr)
+
+
+def cache_stats(faces, cache_size=DEFAULT_CACHE_SIZE):
+    """
+    Simulates a FIFO vertex cache over the triangles of faces.
+    """
+    cache = deque()
+    cached = set()
+    misses = 0
+    for v in np.asarray(faces).ravel().tolist():
+        if v in cached:
+            continue
+        misses += 1
+        cache.append(v)
+        cached.add(v)
+        if len(cache) > cache_size:
+            cached.discard(cache.popleft())
+
+    return CacheStats(misses, len(faces), len(np.unique(faces)))
+
+
+def vertex_triangles(faces, num_vertices):
+    """
+    Triangles using each vertex, as (offsets, triangles): the triangles of
+    vertex v are triangles[offsets[v]:offsets[v + 1]].
+    """
+    corners = np.asarray(faces, dtype=np.int64).ravel()
+    order = np.argsort(corners, kind='stable')
+    offsets = np.zeros(num_vertices + 1, dtype=np.int64)
+    np.cumsum(np.bincount(corners, minlength=num_vertices), out=offsets[1:])
+    return offsets, order // 3
+
+
+def tipsify(faces, num_vertices, cache_size=DEFAULT_CACHE_SIZE):
+    """
+    Returns faces reordered for vertex cache locality. The winding of every
+    triangle is kept.
+
+    Tipsy fans around one vertex at a time, emitting all of its remaining
+    triangles, then moves on to the vertex among those just emitted that
+    is most likely to still be in the cache and still has triangles left.
+    """
+    faces = np.asarray(faces)
+    num_faces = len(faces)
+    if num_faces == 0:
+        return faces.copy()
+
+    offsets, triangles = vertex_triangles(faces, num_vertices)
+    offsets = offsets.tolist()
+    triangles = triangles.tolist()
+    corners = faces.tolist()
+
+    live = np.bincount(faces.ravel(), minlength=num_vertices).tolist()
+    cache_time = [0] * num_vertices
+    emitted = [False] * num_faces
+    dead_end = []
+    output = []
+
+    time_stamp = cache_size + 1
+    cursor = 0
+    fan = int(faces[0][0])
+
+    while fan >= 0:
+        candidates = []
+        for t in triangles[offsets[fan]:offsets[fan + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            output.append(t)
+            for v in corners[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time_stamp - cache_time[v] > cache_size:
+                    cache_time[v] = time_stamp
+                    time_stamp += 1
+
+        # Next fan: the candidate that will still be cached after its
+        # remaining triangles are emitted, and has been so the longest
+        fan = -1
+        best = -1
+        for v in candidates:
+            if live[v] <= 0:
+                continue
+            priority = 0
+            age = time_stamp - cache_time[v]
+            if age + 2 * live[v] <= cache_size:
+                priority = age
+            if priority > best:
+                best = priority
+                fan = v
+
+        if fan < 0:
+            # Dead end: back up to a recently used vertex, or else scan
+            # forward for any vertex with triangles left
+            while dead_end:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fan = v
+                    break
+            else:
+                while cursor < num_vertices:
+                    if live[cursor] > 0:
+                        fan = cursor
+                        break
+                    cursor += 1
+
+    return faces[output]
+
+
+def reorder_vertices(faces, num_vertices):
+    """
+    Renumbers vertices in the order the triangles first use them.
+
+    Returns the new faces and, for each new vertex, its old index. Vertices
+    no triangle uses are dropped.
+    """
+    corners = np.asarray(faces).ravel()
+    used, first = np.unique(corners, return_index=True)
+    order = used[np.argsort(first, kind='stable')]
+
+    remap = np.full(num_vertices, -1, dtype=np.int64)
+    remap[order] = np.arange(len(order))
+    return remap[faces], order
+
+
+def optimize_faces(faces, num_vertices, cache_size=DEFAULT_CACHE_SIZE):
+    """
+    Reorders triangles with Tipsy and vertices by first use.
+
+    Returns (faces, order, before, after): the new faces, the old index of
+    every new vertex, and the cache statistics before and after.
+    """
+    before = cache_stats(faces, cache_size)
+    faces, order = reorder_vertices(tipsify(faces, num_vertices, cache_size), num_vertices)
+    after = cache_stats(faces, cache_size)
+    return faces, order, before, after
@@ -0,0 +1,110 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Logging setup and per-phase timing shared by the P3M add-ons.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+LOGGER_NAME = "p3m"
+
+VERBOSITY_ITEMS = [
+    ('WARNING', "Quiet", "Only report problems"),
+    ('INFO', "Normal", "Report counts and a timing summary"),
+    ('DEBUG', "Verbose", "Also report every step of the process"),
+]
+
+
+def get_logger(name):
+    return logging.getLogger("{}.{}".format(LOGGER_NAME, name))
+
+
+def set_verbosity(level):
+    """
+    Sets the level of every P3M logger, adding a console handler once.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(level)
+
+
+class Phase():
+    def __init__(self, name, count=None, unit="items"):
+        self.name = name
+        self.count = count
+        self.unit = unit
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return "Phase({!r}, {}, {!r}, {:.6f})".format(self.name, self.count, self.unit, self.seconds)
+
+
+class PhaseTimer():
+    """
+    Collects the wall time of the phases of an import or export.
+
+    The count of a phase may be given up front or set on the yielded Phase
+    once it is known; it is used to report a throughput.
+
+    with timer.phase("decode", unit="records") as phase:
+        model = reader.to_model()
+        phase.count = len(model.vertices)
+    """
+    def __init__(self, title):
+        self.title = title
+        self.phases = []
+
+    @contextmanager
+    def phase(self, name, count=None, unit="items"):
+        """
+        Times a block. Entering a phase again, for instance once per object,
+        adds to its time and count.
+        """
+        current = Phase(name, count, unit)
+        start = time.perf_counter()
+        try:
+            yield current
+        finally:
+            current.seconds = time.perf_counter() - start
+            self._add(current)
+
+    def _add(self, current):
+        for phase in self.phases:
+            if phase.name == current.name:
+                phase.seconds += current.seconds
+                if current.count is not None:
+                    phase.count = (phase.count or 0) + current.count
+                return
+        self.phases.append(current)
+
+    @property
+    def total(self):
+        return sum(phase.seconds for phase in self.phases)
+
+    def report(self):
+        lines = ["{} ({:.3f}s)".format(self.title, self.total)]
+        for phase in self.phases:
+            line = "  {:<10} {:>9.2f} ms".format(phase.name, phase.seconds * 1000.0)
+            if phase.count is not None:
+                line += "  {:>8} {}".format(phase.count, phase.unit)
+                if phase.seconds > 0:
+                    line += "  {:>12.0f} {}/s".format(phase.count / phase.seconds, phase.unit)
+            lines.append(line)
+        return "\n".join(lines)
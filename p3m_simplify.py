@@ -0,0 +1,252 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Level of detail generation for P3M models.
+
+Meshes are simplified with quadric error metrics (Garland and Heckbert,
+"Surface Simplification Using Quadric Error Metrics", 1997) using half
+edge collapses: a vertex is merged into one of its neighbours, so every
+surviving vertex keeps its record, UV, normal, bone and weight untouched.
+
+Collapses are restricted to keep the model intact:
+- both vertices must be bound to the same bone with the same weight;
+- vertices on a boundary never move. P3M vertices are split along UV
+  seams and sharp edges, so those show up as boundaries and are kept;
+- a collapse that would flip a triangle or pinch the surface is skipped.
+"""
+
+import heapq
+
+import numpy as np
+
+import p3m_codec
+import p3m_optimize
+import p3m_skeleton
+
+
+def face_quadrics(positions, faces):
+    """
+    Area weighted plane quadric of every triangle, as the 10 coefficients
+    (aa, ab, ac, ad, bb, bc, bd, cc, cd, dd) of the plane ax + by + cz + d.
+    """
+    a, b, c = (positions[faces[:, i]] for i in range(3))
+    normals = np.cross(b - a, c - a)
+    area = np.linalg.norm(normals, axis=1)
+    unit = np.divide(normals, area[:, None], out=np.zeros_like(normals), where=area[:, None] > 0)
+    planes = np.concatenate((unit, -np.einsum('ij,ij->i', unit, a)[:, None]), axis=1)
+
+    i, j = np.triu_indices(4)
+    return planes[:, i] * planes[:, j] * (area[:, None] * 0.5)
+
+
+def vertex_quadrics(positions, faces):
+    quadrics = np.zeros((len(positions), 10))
+    per_face = face_quadrics(positions, faces)
+    for corner in range(3):
+        np.add.at(quadrics, faces[:, corner], per_face)
+    return quadrics
+
+
+def unique_edges(faces):
+    """
+    Returns the edges of a triangle mesh, lowest vertex first, and the
+    number of triangles using each.
+    """
+    edges = np.sort(np.concatenate((faces[:, (0, 1)], faces[:, (1, 2)], faces[:, (2, 0)])), axis=1)
+    return np.unique(edges.reshape(-1, 2), axis=0, return_counts=True)
+
+
+def boundary_vertices(faces, num_vertices):
+    """
+    Vertices on an edge used by a single triangle.
+    """
+    edges, counts = unique_edges(faces)
+    boundary = np.zeros(num_vertices, dtype=bool)
+    boundary[edges[counts == 1].ravel()] = True
+    return boundary
+
+
+def quadric_area(q):
+    """
+    Total area weight of a quadric. Planes have unit normals, so it is the
+    sum of the aa, bb and cc coefficients.
+    """
+    return q[0] + q[4] + q[7]
+
+
+def quadric_error(q, x, y, z):
+    aa, ab, ac, ad, bb, bc, bd, cc, cd, dd = q
+    return (aa * x * x + 2 * ab * x * y + 2 * ac * x * z + 2 * ad * x
+            + bb * y * y + 2 * bc * y * z + 2 * bd * y
+            + cc * z * z + 2 * cd * z + dd)
+
+
+class Simplifier():
+    """
+    Collapses the cheapest edges of a triangle mesh one at a time.
+
+    skin holds a key per vertex; only vertices with equal keys are merged.
+    error is the largest mean squared distance a collapse moved a vertex
+    from the planes of its original triangles, weighted by their area.
+    """
+    def __init__(self, positions, faces, skin):
+        positions = np.asarray(positions, dtype=np.float64)
+        faces = np.asarray(faces, dtype=np.int64).reshape(-1, 3)
+        num_vertices = len(positions)
+
+        self.positions = positions.tolist()
+        self.faces = faces.tolist()
+        self.quadrics = vertex_quadrics(positions, faces).tolist()
+        self.locked = boundary_vertices(faces, num_vertices).tolist()
+        self.skin = list(skin)
+
+        self.face_alive = [True] * len(self.faces)
+        self.num_faces = len(self.faces)
+        self.vertex_faces = [set() for _ in range(num_vertices)]
+        for f, face in enumerate(self.faces):
+            for v in face:
+                self.vertex_faces[v].add(f)
+
+        self.stamps = [0] * num_vertices
+        self.error = 0.0
+        self.heap = []
+        edges, _ = unique_edges(faces)
+        for u, v in edges.tolist():
+            self._push(u, v)
+
+    def _neighbours(self, v):
+        return {w for f in self.vertex_faces[v] for w in self.faces[f]} - {v}
+
+    def _cost(self, u, v):
+        """
+        Error of moving u onto v, or None if u may not move onto v.
+        """
+        if self.locked[u] or self.skin[u] != self.skin[v]:
+            return None
+        qu = self.quadrics[u]
+        qv = self.quadrics[v]
+        x, y, z = self.positions[v]
+        return quadric_error([a + b for a, b in zip(qu, qv)], x, y, z)
+
+    def _push(self, a, b):
+        for u, v in ((a, b), (b, a)):
+            cost = self._cost(u, v)
+            if cost is not None:
+                heapq.heappush(self.heap, (cost, u, v, self.stamps[u], self.stamps[v]))
+
+    def _can_collapse(self, u, v):
+        shared = self.vertex_faces[u] & self.vertex_faces[v]
+        if not shared:
+            return False
+
+        # Link condition: the only common neighbours are the opposite
+        # corners of the triangles being removed
+        opposite = {w for f in shared for w in self.faces[f]} - {u, v}
+        if self._neighbours(u) & self._neighbours(v) != opposite:
+            return False
+
+        pv = self.positions[v]
+        for f in self.vertex_faces[u] - shared:
+            corners = [self.positions[w] for w in self.faces[f]]
+            before = _normal(*corners)
+            corners = [pv if w == u else self.positions[w] for w in self.faces[f]]
+            after = _normal(*corners)
+            if before[0] * after[0] + before[1] * after[1] + before[2] * after[2] <= 0:
+                return False
+        return True
+
+    def _collapse(self, u, v):
+        shared = self.vertex_faces[u] & self.vertex_faces[v]
+        for f in shared:
+            self.face_alive[f] = False
+            self.num_faces -= 1
+            for w in self.faces[f]:
+                if w != u:
+                    self.vertex_faces[w].discard(f)
+
+        for f in self.vertex_faces[u] - shared:
+            self.faces[f] = [v if w == u else w for w in self.faces[f]]
+            self.vertex_faces[v].add(f)
+        self.vertex_faces[u] = set()
+
+        self.quadrics[v] = [a + b for a, b in zip(self.quadrics[u], self.quadrics[v])]
+        self.stamps[u] += 1
+        self.stamps[v] += 1
+
+        for w in self._neighbours(v):
+            self._push(v, w)
+
+    def simplify(self, target_faces):
+        """
+        Collapses edges until at most target_faces triangles remain or no
+        collapse is allowed. Can be called again with a lower target.
+        """
+        while self.num_faces > target_faces and self.heap:
+            cost, u, v, stamp_u, stamp_v = heapq.heappop(self.heap)
+            if stamp_u != self.stamps[u] or stamp_v != self.stamps[v]:
+                continue
+            if not self._can_collapse(u, v):
+                continue
+            # The quadric cost grows with the area it covers, dividing by
+            # that area turns it into a squared distance
+            area = quadric_area(self.quadrics[u]) + quadric_area(self.quadrics[v])
+            if area > 0:
+                self.error = max(self.error, cost / area)
+            self._collapse(u, v)
+        return self.num_faces
+
+    def current_faces(self):
+        alive = [face for face, is_alive in zip(self.faces, self.face_alive) if is_alive]
+        return np.array(alive, dtype=np.int64).reshape(-1, 3)
+
+
+def _normal(a, b, c):
+    ux, uy, uz = b[0] - a[0], b[1] - a[1], b[2] - a[2]
+    vx, vy, vz = c[0] - a[0], c[1] - a[1], c[2] - a[2]
+    return (uy * vz - uz * vy, uz * vx - ux * vz, ux * vy - uy * vx)
+
+
+class LevelOfDetail():
+    def __init__(self, level, model, error):
+        self.level = level
+        self.model = model
+        # Root mean square distance, in model units, of the worst collapse
+        # from the surface it replaced
+        self.error = error
+
+    def __repr__(self):
+        return "LevelOfDetail({}, {} faces, RMS error {:.6f})".format(self.level, len(self.model.triangles), self.error)
+
+
+def lod_chain(model, levels, ratio=0.5):
+    """
+    Returns `levels` LevelOfDetail of a model, level n aiming for ratio ** n
+    of its triangles. Each level is simplified from the previous one.
+    """
+    skeleton = p3m_skeleton.resolve_skeleton(model.position_bones, model.angle_bones)
+    bones = p3m_skeleton.vertex_bones(model)
+    positions = p3m_skeleton.absolute_positions(model, skeleton, bones)
+    faces = model.triangles['index'].astype(np.int64)
+
+    skin = list(zip(model.vertices['bone'].tolist(), model.vertices['weight'].tolist()))
+    simplifier = Simplifier(positions, faces, skin)
+
+    chain = []
+    for level in range(1, levels + 1):
+        simplifier.simplify(int(len(faces) * ratio ** level))
+        lod_faces, order = p3m_optimize.reorder_vertices(simplifier.current_faces(), len(positions))
+        lod = p3m_codec.P3MModel(model.version, model.position_bones, model.angle_bones,
+                                 p3m_codec.make_triangles(lod_faces), model.vertices[order], model.texture)
+        chain.append(LevelOfDetail(level, lod, float(np.sqrt(max(simplifier.error, 0.0)))))
+    return chain
@@ -0,0 +1,219 @@
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTIBILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bone hierarchy of Perfect 3D Model (.p3m) files.
+
+A P3M skeleton is stored as two tables: position bones list the angle
+bones sitting at their location and angle bones list the position bones of
+their children. This module turns those tables into a parent array and
+works out the bone heads and tails without depending on bpy.
+"""
+
+import numpy as np
+
+import p3m_codec
+
+BONE_TAIL_LENGTH = 0.05
+
+
+class BoneTree():
+    """
+    Parent/children view of a skeleton with a topological order.
+
+    Every bone appears in `order` after its parent, so walking it forwards
+    propagates values from the roots and walking it backwards folds values
+    from the leaves up.
+    """
+    def __init__(self, parents):
+        self.parents = list(parents)
+        self.children = [[] for _ in self.parents]
+        self.roots = []
+
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.children[parent].append(i)
+            else:
+                self.roots.append(i)
+
+        self.order = list(self.roots)
+        visited = set(self.order)
+        for i in self.order:
+            for child in self.children[i]:
+                if child not in visited:
+                    visited.add(child)
+                    self.order.append(child)
+
+        # Bones caught in a parenting cycle are never reached from a root
+        self.order.extend(i for i in range(len(self.parents)) if i not in visited)
+
+    def __len__(self):
+        return len(self.parents)
+
+    def __repr__(self):
+        return "BoneTree({})".format(self.parents)
+
+    def subtree_totals(self, values):
+        """
+        Sums a per-bone value over each bone and all of its descendants.
+        """
+        totals = np.array(values)
+        for i in reversed(self.order):
+            parent = self.parents[i]
+            if parent >= 0:
+                totals[parent] += totals[i]
+        return totals
+
+
+class Skeleton():
+    """
+    Angle bones of a P3M file resolved into a tree with absolute heads and
+    tails, in file space.
+    """
+    def __init__(self, tree, angle_to_position, heads, tails):
+        self.tree = tree
+        self.angle_to_position = angle_to_position
+        self.heads = heads
+        self.tails = tails
+
+    def __len__(self):
+        return len(self.tree)
+
+
+def angle_children(position_children, angle_children_positions):
+    """
+    Child angle bones of every angle bone, going through the position bones.
+    """
+    return [[angle for position in positions for angle in position_children[position]]
+            for positions in angle_children_positions]
+
+
+def resolve_skeleton(position_bones, angle_bones):
+    """
+    Builds the bone tree from the position and angle bone sections.
+
+    Each angle bone takes its (relative) head from the position bone that
+    lists it as a child. Heads are then made absolute walking the tree from
+    the roots. A bone with a single child points its tail at that child,
+    other bones get a short tail following their parent's direction.
+
+    Raises P3MError when a child index points past the end of its table.
+    """
+    position_children = p3m_codec.child_lists(position_bones['child_index'])
+    angle_positions = p3m_codec.child_lists(angle_bones['child_index'])
+    dwNumPositionBone = len(position_bones)
+    dwNumAngleBone = len(angle_bones)
+
+    angle_to_position = [-1] * dwNumAngleBone
+    for j, children in enumerate(position_children):
+        for i in children:
+            if i >= dwNumAngleBone:
+                raise p3m_codec.P3MError("Position bone {} holds angle bone {}, the file has {} angle bones".format(
+                    j, i, dwNumAngleBone))
+            angle_to_position[i] = j
+
+    for i, positions in enumerate(angle_positions):
+        for j in positions:
+            if j >= dwNumPositionBone:
+                raise p3m_codec.P3MError("Angle bone {} has child position bone {}, the file has {} position bones".format(
+                    i, j, dwNumPositionBone))
+
+    children = angle_children(position_children, angle_positions)
+    parents = [-1] * dwNumAngleBone
+    for i, chIndex in enumerate(children):
+        for idx in chIndex:
+            parents[idx] = i
+
+    tree = BoneTree(parents)
+
+    heads = np.zeros((dwNumAngleBone, 3), dtype=np.float64)
+    vectors = position_bones['vector'].astype(np.float64)
+    for i, j in enumerate(angle_to_position):
+        if j >= 0:
+            heads[i] = vectors[j]
+
+    for i in tree.order:
+        parent = tree.parents[i]
+        if parent >= 0:
+            heads[i] += heads[parent]
+
+    tails = heads.copy()
+    for i in tree.order:
+        if len(children[i]) == 1:
+            tails[i] = heads[children[i][0]]
+            continue
+
+        parent = tree.parents[i]
+        if parent >= 0:
+            direction = tails[parent] - heads[parent]
+            length = np.linalg.norm(direction)
+            v = direction / length * BONE_TAIL_LENGTH if length > 0 else np.zeros(3)
+        else:
+            v = np.array((0.0, BONE_TAIL_LENGTH, 0.0))
+        tails[i] = heads[i] + v
+
+    return Skeleton(tree, angle_to_position, heads, tails)
+
+
+def vertex_bones(model):
+    """
+    Angle bone index of every vertex, -1 for vertices without a bone.
+
+    Vertices reference their bone by its index after the position bones.
+    Raises P3MError for a vertex bound to a bone the file does not have.
+    """
+    bones = model.vertices['bone'].astype(np.int32)
+    skinned = bones != p3m_codec.NO_BONE
+    bones[skinned] -= len(model.position_bones)
+    bones[~skinned] = -1
+
+    invalid = np.flatnonzero(skinned & ((bones < 0) | (bones >= len(model.angle_bones))))
+    if len(invalid):
+        v = int(invalid[0])
+        raise p3m_codec.P3MError("Vertex {} is bound to bone {}, the file has {} position and {} angle bones".format(
+            v, int(model.vertices['bone'][v]), len(model.position_bones), len(model.angle_bones)))
+    return bones
+
+
+def absolute_positions(model, skeleton, bones):
+    """
+    Vertex positions with the head of their bone added back.
+    """
+    positions = model.vertices['position'].astype(np.float64)
+    skinned = bones >= 0
+    positions[skinned] += skeleton.heads[bones[skinned]]
+    return positions
+
+
+def relative_positions(positions, skeleton, bones):
+    """
+    Inverse of absolute_positions.
+    """
+    positions = np.array(positions, dtype=np.float64)
+    skinned = bones >= 0
+    positions[skinned] -= skeleton.heads[bones[skinned]]
+    return positions
+
+
+def bounding_box(model, skeleton=None):
+    """
+    Bounds (low, high) of the absolute vertex positions, or None for a
+    model without vertices. Only the position and bone fields are read, so
+    a strided view of a mapped file is enough.
+    """
+    if len(model.vertices) == 0:
+        return None
+    if skeleton is None:
+        skeleton = resolve_skeleton(model.position_bones, model.angle_bones)
+    positions = absolute_positions(model, skeleton, vertex_bones(model))
+    return positions.min(axis=0), positions.max(axis=0)